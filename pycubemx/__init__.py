@@ -1,8 +1,20 @@
 import sys
 from .native import *
 from .config import *
+from .pool import *
+from .aio import *
+from .batch import *
+from .script import *
+from .cache import *
+from .decoders import *
+from .metrics import *
+from .transcript import *
 
-__ALL__ = ("MxConnection", "MxException", "MxCommandError", "MxStatus", 'Config','ConfigException')
+__ALL__ = ("MxConnection", "MxException", "MxCommandError", "MxStatus", 'Config','ConfigException',
+           "MxSessionPool", "MxPoolException", "AsyncMxConnection",
+           "MxBatch", "MxFuture", "MxScript", "MxQueryCache", "MxMetrics",
+           "MxReplayConnection",
+           "Pin", "Interrupt", "DmaRequest", "IpParameter")
 
 if (sys.version_info < (3, 5)):
     print ("Requires python 3.5 or later.")
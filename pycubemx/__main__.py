@@ -2,6 +2,9 @@ import logging
 import json
 from .config import Config
 from .native import MxConnection
+from .stamp import GenerateStamp
+from .sync import StagedOutput
+from .daemon import MxDaemonClient, MxDaemonException
 import argparse
 from pathlib import Path
 import sys
@@ -17,12 +20,17 @@ parser.add_argument('--config', required=False,
                     help='Overrides the local configuration file.\nDefault:' + Config.LocalConfigFile)
 parser.add_argument('--config-no-defaults', action='store_true',
                     help='Don\'t load the default command set/settings.')
+parser.add_argument('--no-daemon', action='store_true',
+                    help='Start a private STM32CubeMX session instead of using the background daemon.')
 # Dump Command
 op_dump = subparsers.add_parser("dump",
                                 help="Dump the command set.")
 # Dump Command
 op_help = subparsers.add_parser("show-help",
                                 help="Show help info from CubeMX.")
+# Daemon
+op_stop_daemon = subparsers.add_parser("stop-daemon",
+                                help="Stop the background daemon for this configuration.")
 
 # Generate Function
 op_generate = subparsers.add_parser("generate",
@@ -33,8 +41,42 @@ op_generate.add_argument('outdir',
                     help='The output directory.')
 op_generate.add_argument('--single', action='store_true',
                     help='Use a single file to store IP settings. As opposed to multiple files.')
+op_generate.add_argument('--stamp',
+                    help='Stamp file used to skip generation when nothing changed.\nDefault: <outdir>/.pycubemx.stamp')
+op_generate.add_argument('--depfile',
+                    help='Also write a Make/Ninja depfile listing the generated files.')
+op_generate.add_argument('--force', action='store_true',
+                    help='Generate even if the stamp says the outputs are up to date.')
+op_generate.add_argument('--sync', action='store_true',
+                    help='Generate into a staging directory and only write files whose content changed.')
+op_generate.add_argument('--remove-stale', action='store_true',
+                    help='With --sync, delete files in the output directory that were not regenerated.')
 args = parser.parse_args()
 
+def openSession ():
+    # Reuse the warm session held by the background daemon when possible.
+    if not args.no_daemon and config.daemon.enabled and MxDaemonClient.available():
+        client = MxDaemonClient(config, configFile=args.config, nodefaults=args.config_no_defaults)
+        try:
+            client.connect()
+            return client
+        except MxDaemonException as e:
+            Log.warning("Daemon unavailable ({}), using a private session.".format(str(e)))
+    return MxConnection(config)
+
+def generate (session, project, target):
+    # One command at a time, so nothing after a failed load reaches CubeMX.
+    with session.batch(stopOnError=True, window=1):
+        steps = [session.config.load(project)]
+        if args.single:
+            steps.append(session.generate.all_code_in_main())
+        else:
+            steps.append(session.generate.one_file_per_ip())
+        steps.append(session.generate.code(target))
+    for i in steps:
+        if not i.ok:
+            raise Exception("'{}' failed: {}".format(i.command, i.status.name))
+
 # Start Work!
 if args.command is None:
     Log.error("Must specify a command!")
@@ -49,16 +91,39 @@ if args.command == 'dump':
     session.dump(includeHelp=True)
     sys.exit(0)
 
-with MxConnection(config) as session:
+if args.command == "generate":
+    input = str(Path(args.project).resolve())
+    output = str(Path(args.outdir).resolve())
+    stampFile = args.stamp if args.stamp is not None else str(Path(output, ".pycubemx.stamp"))
+    stamp = GenerateStamp(stampFile, args.depfile)
+    fingerprint = GenerateStamp.fingerprint(input, config.STM32CubeMX, outdir=output, single=args.single,
+                                            sync=args.sync, removeStale=args.remove_stale)
+    if not args.force and stamp.upToDate(fingerprint):
+        Log.info("Up to date: " + output)
+        sys.exit(0)
+
+if args.command == 'stop-daemon':
+    if MxDaemonClient(config).shutdownDaemon():
+        Log.info("Daemon stopped.")
+    else:
+        Log.info("Daemon not running.")
+    sys.exit(0)
+
+with openSession() as session:
     if args.command == "generate":
-        input = str(Path(args.project).resolve())
-        output = str(Path(args.outdir).resolve())
         try:
-            session.config.load(input)
-            session.generate.one_file_per_ip()
-            session.generate.code(output)
+            exclude = (Path(stampFile).resolve(), Path(args.depfile).resolve() if args.depfile else None)
+            if args.sync:
+                with StagedOutput(output, removeStale=args.remove_stale, exclude=exclude) as staging:
+                    generate(session, input, staging.path)
+                outputs = [str(Path(output, i)) for i in staging.summary.outputs]
+            else:
+                generate(session, input, output)
+                outputs = GenerateStamp.scan(output, exclude)
+            stamp.write(fingerprint, input, outputs)
         except:
             Log.exception ("Failed to complete code generation successfully...")
+            sys.exit(-1)
     elif args.command == "show-help":
         for i in session.help():
             Log.info(">>> " + i)
@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+from .native import (MxConnection, MxException, MxCommandError, MxStatus, Encoding,
+                     Log as NativeLog, LogCubeLogs, LogCubeResp, LogCubeExec,
+                     _buildNamespace, _scanPrompt, _feedLine)
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("AsyncMxConnection",)
+
+# CubeMX can print very long lines (pin lists, MCU tables...)
+_STREAM_LIMIT = 1024 * 1024
+
+class AsyncMxConnection (object):
+    """
+    asyncio counterpart to MxConnection. The command tree is the same, but
+    every call returns a coroutine:
+
+        async with AsyncMxConnection(config) as session:
+            await session.config.load(path)
+            await session.generate.code(outdir, timeout=600)
+
+    Many sessions can be driven from one event loop. A call that times out or
+    is cancelled while CubeMX is working leaves the pipe out of step, so the
+    process is killed and the next call starts a fresh session.
+    """
+    def __init__ (self, config, decode = False):
+        self._config = config
+        self._decode = decode
+        self._proc = None
+        self._lock = None
+        self._stderrTask = None
+        self._cubemx = None
+        self.startupTime = None
+        config.configureLogger(LogCubeLogs)
+        config.configureLogger(LogCubeResp)
+        config.configureLogger(LogCubeExec)
+        config.configureLogger(NativeLog)
+        config.configureLogger(Log)
+        self._ns = _buildNamespace(config, self)
+
+    async def __aenter__ (self):
+        await self.connect()
+        return self
+
+    async def __aexit__ (self, type, value, traceback):
+        await self.disconnect()
+
+    @property
+    def alive (self):
+        return self._proc is not None and self._proc.returncode is None
+
+    def _session_lock (self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def connect (self, timeout = None):
+        if self._proc is not None:
+            if self.alive:
+                Log.info("Already connected.")
+                return
+            await self.disconnect()
+
+        self._cubemx = self._config.STM32CubeMX
+        if self._cubemx.valid is False:
+            raise MxException("STM32CubeMX tool not found.")
+        if timeout is None:
+            timeout = self._cubemx.startupTimeout
+        cmd = [self._cubemx.command] + list(self._cubemx.arguments) + ["-s"]
+        Log.info("Connecting> " + " ".join(cmd))
+        started = time.monotonic()
+        try:
+            self._proc = await asyncio.create_subprocess_exec(*cmd,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    limit=_STREAM_LIMIT)
+        except FileNotFoundError as e:
+            Log.error("Unable to locate STM32CubeMX executable.")
+            raise MxException("STM32CubeMX cannot be executed.")
+        self._stderrTask = asyncio.ensure_future(self._drainStderr(self._proc))
+
+        Log.info("Waiting until session ready...")
+        try:
+            await asyncio.wait_for(self._waitForPrompt(), timeout)
+        except asyncio.TimeoutError:
+            await self._kill()
+            raise MxException("STM32CubeMX did not become ready in time.")
+        except BaseException:
+            await self._kill()
+            raise
+        self.startupTime = time.monotonic() - started
+        Log.info("Session Ready! ({:.3f}s)".format(self.startupTime))
+
+    async def _waitForPrompt (self):
+        pending = b""
+        while True:
+            chunk = await self._proc.stdout.read(4096)
+            if len(chunk) == 0:
+                raise MxException("STM32CubeMX exited before it was ready.")
+            ready, pending = _scanPrompt(pending, chunk)
+            if ready:
+                return
+
+    async def _drainStderr (self, proc):
+        # Nobody reads stderr otherwise; a full pipe would stall CubeMX.
+        while True:
+            line = await proc.stderr.readline()
+            if len(line) == 0:
+                return
+            LogCubeLogs.debug("(stderr) " + line.decode(Encoding, "replace").rstrip())
+
+    async def _kill (self):
+        proc, self._proc = self._proc, None
+        if proc is None:
+            return
+        if proc.returncode is None:
+            try:
+                proc.kill()
+            except ProcessLookupError:
+                pass
+            # wait() also waits for the pipes to close; drain stdout in case
+            # reading it was paused with a full buffer.
+            while len(await proc.stdout.read(65536)) > 0:
+                pass
+            await proc.wait()
+        if self._stderrTask is not None:
+            self._stderrTask.cancel()
+            self._stderrTask = None
+
+    async def disconnect (self):
+        Log.info("Disconnecting")
+        proc = self._proc
+        if proc is None:
+            return
+        if proc.returncode is None:
+            try:
+                proc.stdin.write(bytes("exit\n", Encoding))
+                await proc.stdin.drain()
+                await asyncio.wait_for(proc.wait(), 5)
+            except asyncio.TimeoutError:
+                Log.info("Timeout - Force")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        await self._kill()
+
+    def __getattr__ (self, name):
+        return self._ns.__getattr__(name)
+
+    def _getcall (self, api):
+        return self._ns._lookup(api)
+
+    def _invoke (self, caller, args, timeout = None, force = False):
+        # No session state is tracked here, so nothing is elided and force
+        # has nothing to override.
+        return self._call(caller, caller.encode(args), timeout)
+
+    async def _call (self, caller, coder, timeout):
+        await self._transact(coder, timeout)
+        if coder.status in (MxStatus.MxTimeout, MxStatus.MxTerminated):
+            raise MxCommandError(coder.status, "Command '" + coder.command + "' did not complete.")
+        return caller._complete(coder)
+
+    def _stream (self, transact, caller = None, args = (), timeout = None):
+        raise MxException("stream() and spool() are not supported by AsyncMxConnection, await the call instead.")
+
+    async def _transact (self, transact, timeout = None):
+        Log.debug("mx exec>> " + transact.command)
+        async with self._session_lock():
+            if not self.alive:
+                await self.connect()
+            try:
+                await asyncio.wait_for(self._exchange(transact), timeout)
+            except asyncio.TimeoutError:
+                Log.error("Timeout: " + transact.command)
+                transact.fail(MxStatus.MxTimeout)
+                await self._kill()
+            except (EOFError, BrokenPipeError, ConnectionResetError) as e:
+                Log.error("Error: {}".format(str(e)))
+                transact.fail(MxStatus.MxTerminated)
+                await self._kill()
+            except asyncio.CancelledError:
+                # Partially read response - the session can't be trusted anymore.
+                transact.fail(MxStatus.MxTerminated)
+                await self._kill()
+                raise
+            finally:
+                LogCubeExec.debug("(done) " + transact.command + " -> " + transact.status.name)
+
+    async def _exchange (self, transact):
+        LogCubeExec.debug("(start) " + transact.command)
+        self._proc.stdin.write(bytes(transact.command + "\n", Encoding))
+        await self._proc.stdin.drain()
+        while transact.pending:
+            try:
+                line = await self._proc.stdout.readline()
+            except (asyncio.LimitOverrunError, ValueError):
+                # A line over _STREAM_LIMIT: the rest of it is still in the
+                # pipe, so the session can't be used anymore.
+                Log.error("Line too long in response to: " + transact.command)
+                line = b""
+            if len(line) == 0:
+                transact.fail(MxStatus.MxTerminated)
+                await self._kill()
+                return
+            _feedLine(transact, line.decode(Encoding, "replace"))
+
+    def dump (self, wrfunc = None, **kwargs):
+        if wrfunc is None:
+            wrfunc = lambda msg: Log.info(msg)
+        self._ns._dump(wrfunc=wrfunc, **kwargs)
@@ -0,0 +1,119 @@
+import logging
+from .native import MxCommandError, MxStatus, MxException
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("MxBatch", "MxFuture")
+
+class MxFuture (object):
+    """ The pending result of a call queued in a batch. """
+    def __init__ (self, owner, caller, coder, args = ()):
+        self._owner = owner
+        self._caller = caller
+        self._coder = coder
+        self._args = args
+        self._done = False
+        self._result = None
+        self._exception = None
+
+    @property
+    def command (self):
+        return self._coder.command
+
+    @property
+    def status (self):
+        return self._coder.status
+
+    @property
+    def ok (self):
+        return self._done and self._coder.status == MxStatus.MxOK
+
+    def done (self):
+        return self._done
+
+    def _resolve (self):
+        if self._coder.status == MxStatus.MxUnprocessed:
+            self._exception = MxCommandError(self._coder.status, "Command '" + self._coder.command + "' was not executed.")
+        elif self._coder.status in (MxStatus.MxTimeout, MxStatus.MxTerminated):
+            self._exception = MxCommandError(self._coder.status, "Command '" + self._coder.command + "' did not complete.")
+        else:
+            try:
+                self._result = self._caller._complete(self._coder)
+            except MxException as e:
+                self._exception = e
+        self._done = True
+
+    def result (self):
+        if not self._done:
+            self._owner.flush()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception (self):
+        if not self._done:
+            self._owner.flush()
+        return self._exception
+
+    def __str__ (self):
+        return "Future<" + self._coder.command + ": " + self._coder.status.name + ">"
+
+class MxBatch (object):
+    """
+    Queues calls made on a session while the with block is active and sends
+    them pipelined on exit (or when a future's result is needed). Use
+    MxConnection.batch() to create one.
+    """
+    def __init__ (self, session, stopOnError = False, window = 32):
+        self._session = session
+        self._stopOnError = stopOnError
+        self._window = max(1, window)
+        self._queued = []
+        self.futures = []
+
+    def __enter__ (self):
+        if self._session._batch is not None:
+            raise MxException("A batch is already active on this session.")
+        self._session._batch = self
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self._session._batch = None
+        if type is None:
+            self.flush()
+        else:
+            # Don't run half a script if the block itself failed.
+            for i in self._queued:
+                i._resolve()
+            self._queued = []
+
+    def __getattr__ (self, name):
+        return getattr(self._session, name)
+
+    def _queue (self, caller, args):
+        future = MxFuture(self, caller, caller.encode(args), args)
+        self._queued.append(future)
+        self.futures.append(future)
+        return future
+
+    def flush (self):
+        queued, self._queued = self._queued, []
+        if len(queued) == 0:
+            return
+        if self._stopOnError and len(self.failed) > 0:
+            for i in queued:
+                i._resolve()
+            return
+        batch, self._session._batch = self._session._batch, None
+        try:
+            self._session._transactMany([i._coder for i in queued],
+                    window=self._window, stopOnError=self._stopOnError,
+                    calls=[(i._caller, i._args) for i in queued])
+        finally:
+            self._session._batch = batch
+        for i in queued:
+            i._resolve()
+
+    @property
+    def failed (self):
+        return [i for i in self.futures if i.done() and not i.ok]
@@ -0,0 +1,4 @@
+from .parsing import *
+from .suite import *
+
+__ALL__ = ('benchParsing', 'benchSuite')
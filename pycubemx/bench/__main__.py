@@ -0,0 +1,63 @@
+import logging
+import json
+import argparse
+import sys
+from .parsing import benchParsing
+from .suite import benchSuite, Benchmarks
+
+FORMAT = '[%(name)-15s - %(levelname)-6s] %(message)s'
+logging.basicConfig(format=FORMAT,level=logging.INFO)
+Log = logging.getLogger('cubemx-bench')
+
+parser = argparse.ArgumentParser(description='pycubemx micro benchmarks.')
+subparsers = parser.add_subparsers(help='Benchmark', dest="bench")
+subparsers.required = True
+op_parsing = subparsers.add_parser("parsing",
+                                help="Response parsing throughput (lines/sec).")
+op_parsing.add_argument('--commands', type=int, default=200,
+                    help='Number of command responses to parse.')
+op_parsing.add_argument('--lines', type=int, default=1000,
+                    help='Response lines per command.')
+op_parsing.add_argument('--log-every', type=int, default=2,
+                    help='Interleave a CubeMX log line every N response lines (0 for none).')
+op_suite = subparsers.add_parser("suite",
+                                help="End to end benchmarks against a fake CubeMX.")
+op_suite.add_argument('--startup', type=float, default=1.0,
+                    help='Injected CubeMX start-up delay in seconds.')
+op_suite.add_argument('--latency', type=float, default=0.005,
+                    help='Injected per-command latency in seconds for the parallel benchmark.')
+op_suite.add_argument('--commands', type=int, default=500,
+                    help='Commands per round trip benchmark.')
+op_suite.add_argument('--large-lines', type=int, default=100000,
+                    help='Response lines for the large output benchmark.')
+op_suite.add_argument('--pool-sizes', type=int, nargs='+', default=[1, 2, 4],
+                    help='Session pool sizes for the parallel benchmark.')
+op_suite.add_argument('--jobs', type=int, default=16,
+                    help='Jobs per pool size.')
+op_suite.add_argument('--commands-per-job', type=int, default=20,
+                    help='Commands per parallel job.')
+op_suite.add_argument('--repeat', type=int, default=3,
+                    help='Repetitions of the start-up and large output benchmarks.')
+op_suite.add_argument('--only', nargs='+', choices=Benchmarks,
+                    help='Run only these benchmarks.')
+op_suite.add_argument('--output',
+                    help='Write the JSON results to this file instead of stdout.')
+args = parser.parse_args()
+
+if args.bench == "parsing":
+    result = benchParsing(args.commands, args.lines, args.log_every)
+    for i in ("legacy", "current"):
+        Log.info("{:8} {:>12.0f} lines/sec".format(i, result[i]["lines_per_sec"]))
+    Log.info("speedup  {:.2f}x".format(result["speedup"]))
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write("\n")
+elif args.bench == "suite":
+    result = benchSuite(args.startup, args.latency, args.commands, args.large_lines, args.pool_sizes,
+                        args.jobs, args.commands_per_job, args.repeat, args.only)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        Log.info("Results written to " + args.output)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
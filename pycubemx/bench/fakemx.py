@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+A stand-in for STM32CubeMX that speaks its interactive protocol: timestamped
+log lines, the MX> prompt and 'N OK' / 'N KO' terminators. Start-up delay,
+per-command latency and output size are configurable so the benchmarks can
+run anywhere. Standalone on purpose - it is run by path, not as a module.
+
+    fakemx.py --startup 2 --latency 0.01 --lines 3 --output "get pinout=2000" -s
+
+Commands starting with 'fail' answer KO, 'exit' ends the session. With
+'-s <file>' the file is run as a script, as CubeMX does.
+"""
+import sys
+import time
+import argparse
+
+def _log (out, msg):
+    now = time.time()
+    out.write("{},{:03d} [INFO] {}\n".format(time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+                                             int(now * 1000) % 1000, msg))
+
+def _outputSize (args, command):
+    for i in args.output:
+        prefix, _, count = i.rpartition("=")
+        if command.startswith(prefix):
+            return int(count)
+    return args.lines
+
+def main (argv = None):
+    parser = argparse.ArgumentParser(description="Fake STM32CubeMX for benchmarks.")
+    parser.add_argument("--startup", type=float, default=0.0, help="Start-up delay in seconds.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Delay before each response in seconds.")
+    parser.add_argument("--lines", type=int, default=3, help="Response lines per command.")
+    parser.add_argument("--output", action="append", default=[],
+                        help="'<command prefix>=<lines>' overrides --lines for matching commands.")
+    parser.add_argument("--fail", action="append", default=[],
+                        help="Commands starting with this prefix answer KO.")
+    parser.add_argument("--log-every", type=int, default=0,
+                        help="Interleave a log line every N response lines (0 for none).")
+    parser.add_argument("-s", dest="script", nargs="?", const="", default="",
+                        help="Script to run; interactive without one.")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    time.sleep(args.startup)
+    for i in range(5):
+        _log(out, "Starting up ({})".format(i))
+    interactive = len(args.script) == 0
+    src = sys.stdin if interactive else open(args.script)
+    if interactive:
+        out.write("MX>\n")
+        out.flush()
+
+    n = 0
+    for line in src:
+        command = line.strip()
+        if len(command) == 0:
+            continue
+        n += 1
+        if command == "exit":
+            break
+        if args.latency > 0:
+            time.sleep(args.latency)
+        _log(out, "Executing " + command)
+        if command.startswith("fail") or any(command.startswith(i) for i in args.fail):
+            out.write("Error: {}\n{} KO\n".format(command, n))
+        else:
+            for i in range(_outputSize(args, command)):
+                if args.log_every and i % args.log_every == 0:
+                    _log(out, "Processing {}".format(i))
+                out.write("PA{} GPIO_Output label{} {}\n".format(i % 16, i, n))
+            out.write("{} OK\n".format(n))
+        out.flush()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
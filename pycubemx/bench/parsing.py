@@ -0,0 +1,101 @@
+import os
+import re
+import logging
+import threading
+import time
+from ..native import (MxConnection, Coder, Encoding, LogCubeLogs, LogCubeResp, LogCubeExec,
+                      _PipeReader, _feedLine)
+
+__ALL__ = ('benchParsing',)
+
+def _sampleOutput (commands, linesPerCommand, logEvery):
+    out = []
+    for n in range(commands):
+        for i in range(linesPerCommand):
+            if logEvery and i % logEvery == 0:
+                out.append("2018-08-30 01:36:30,123 [INFO] CodeEngine:{} Processing template {}\n".format(n, i))
+            out.append("PA{}-WKUP : GPIO_Output label{} param {} value {}\n".format(i % 16, n, i, i * 7))
+        out.append("{} OK\n".format(n + 1))
+    return "".join(out).encode(Encoding)
+
+def _pipe (payload):
+    r, w = os.pipe()
+    def writer ():
+        view = memoryview(payload)
+        while len(view) > 0:
+            count = os.write(w, view[:65536])
+            view = view[count:]
+        os.close(w)
+    t = threading.Thread(target=writer, daemon=True)
+    t.start()
+    return r, t
+
+# The per-line path used before the chunked reader, kept for comparison.
+_LEGACY_RE_LOGITEM = re.compile(r'\d+-\d+-\d+\s+\d+:\d+:\d+,\d+\s+\[\w+\].*')
+_LEGACY_RE_END = re.compile(r"^.*(\d+)\s+(OK|KO)\s*$")
+
+def _legacy (fd, commands):
+    stdout = os.fdopen(fd, "rb")
+    lines = 0
+    for n in range(commands):
+        data = []
+        while True:
+            line = stdout.readline().decode(Encoding)
+            if len(line) == 0:
+                return lines
+            lines += 1
+            line = line.rstrip()
+            if _LEGACY_RE_LOGITEM.match(line):
+                LogCubeLogs.debug("(log) " + line)
+            else:
+                LogCubeResp.debug("(recv) " + line)
+                if _LEGACY_RE_END.match(line):
+                    LogCubeExec.debug("(exitcond) OK")
+                    break
+                data.append(line)
+    stdout.close()
+    return lines
+
+def _current (fd, commands):
+    reader = _PipeReader(fd)
+    lines = 0
+    for n in range(commands):
+        coder = Coder("bench")
+        while coder.pending:
+            line = reader.readline()
+            if line is None:
+                return lines
+            lines += 1
+            _feedLine(coder, line)
+    os.close(fd)
+    return lines
+
+def benchParsing (commands = 200, linesPerCommand = 1000, logEvery = 2, repeat = 3):
+    """ Lines/sec through the response parser, legacy readline/regex path vs the chunked reader. """
+    payload = _sampleOutput(commands, linesPerCommand, logEvery)
+    loggers = (LogCubeLogs, LogCubeResp, LogCubeExec)
+    levels = [i.level for i in loggers]
+    for i in loggers:
+        i.setLevel(logging.CRITICAL)
+    results = {}
+    try:
+        for name, impl in (("legacy", _legacy), ("current", _current)):
+            best = None
+            for _ in range(repeat):
+                fd, writer = _pipe(payload)
+                start = time.perf_counter()
+                lines = impl(fd, commands)
+                elapsed = time.perf_counter() - start
+                writer.join()
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = {
+                "lines" : lines,
+                "bytes" : len(payload),
+                "seconds" : best,
+                "lines_per_sec" : lines / best,
+            }
+    finally:
+        for i, lvl in zip(loggers, levels):
+            i.setLevel(lvl)
+    results["speedup"] = results["current"]["lines_per_sec"] / results["legacy"]["lines_per_sec"]
+    return results
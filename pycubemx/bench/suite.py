@@ -0,0 +1,216 @@
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import logging
+import platform
+import tempfile
+from ..config import Config
+from ..native import MxConnection
+from ..pool import MxSessionPool
+from . import fakemx
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ('benchSuite', 'fakeConfig')
+
+def _freePort ():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def fakeConfig (directory, startup = 0.0, latency = 0.0, lines = 3, output = (), port = None):
+    """ Writes a configuration that runs the fake CubeMX and returns it loaded. """
+    arguments = [os.path.abspath(fakemx.__file__), "--startup", str(startup),
+                 "--latency", str(latency), "--lines", str(lines)]
+    for i in output:
+        arguments += ["--output", i]
+    data = {
+        "STM32CubeMX" : {
+            "command" : sys.executable,
+            "arguments" : arguments,
+            "startup_timeout" : startup + 60,
+            "command_timeout" : 600,
+        },
+        "server" : {
+            "server.socket_port" : port if port is not None else _freePort(),
+            "server.socket_host" : "127.0.0.1",
+            "secret" : "bench",
+        },
+        "log" : {
+            "native.log" : False, "native.response" : False, "native.exec" : False,
+            "pycubemx.native" : False,
+        },
+    }
+    path = os.path.join(directory, "config-{}.json".format(len(os.listdir(directory))))
+    with open(path, "w") as f:
+        json.dump(data, f, indent=2)
+    return Config.LocalConfig(configFile=path)
+
+def _summary (samples):
+    samples = sorted(samples)
+    n = len(samples)
+    return {
+        "n" : n,
+        "min" : samples[0],
+        "median" : samples[n // 2],
+        "mean" : sum(samples) / n,
+        "max" : samples[-1],
+    }
+
+def benchStartup (config, startup, repeat):
+    """ Session start-up, and the part of it that isn't the injected delay. """
+    samples = []
+    for _ in range(repeat):
+        session = MxConnection(config)
+        start = time.perf_counter()
+        session.connect()
+        samples.append(time.perf_counter() - start)
+        session.disconnect()
+    result = _summary(samples)
+    result["injected"] = startup
+    result["overhead"] = result["median"] - startup
+    return result
+
+def benchCommands (config, commands):
+    """ Round trip cost of small commands, one at a time and pipelined. """
+    with MxConnection(config) as session:
+        session.get.mcu.name()
+        start = time.perf_counter()
+        for _ in range(commands):
+            session.get.mcu.name()
+        sequential = time.perf_counter() - start
+        start = time.perf_counter()
+        with session.batch():
+            for _ in range(commands):
+                session.get.mcu.name()
+        pipelined = time.perf_counter() - start
+    return {
+        "commands" : commands,
+        "sequential_us" : sequential / commands * 1e6,
+        "pipelined_us" : pipelined / commands * 1e6,
+        "commands_per_sec" : commands / sequential,
+        "pipelined_commands_per_sec" : commands / pipelined,
+    }
+
+def benchLargeOutput (config, lines, repeat):
+    """ get pinout with a large response, decoded into records. """
+    samples = []
+    with MxConnection(config, decode=True) as session:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            session.get.pinout()
+            samples.append(time.perf_counter() - start)
+    result = _summary(samples)
+    result["lines"] = lines
+    result["lines_per_sec"] = lines / result["median"]
+    return result
+
+def _roundTrips (client, commands):
+    client.init()
+    client.get.mcu.name()
+    start = time.perf_counter()
+    for _ in range(commands):
+        client.get.mcu.name()
+    elapsed = time.perf_counter() - start
+    client.close()
+    return elapsed
+
+def benchServer (config, commands):
+    """ Round trips through MxRemoteClient and the CherryPy server, with and without keep-alive. """
+    try:
+        import cherrypy
+        from ..server.server import CubeMXApi
+        from ..server.client import MxRemoteClient
+    except ImportError as e:
+        return {"skipped" : str(e)}
+    cherrypy.config.update(config.server._config)
+    cherrypy.config.update({"log.screen" : False})
+    api = CubeMXApi(config)
+    cherrypy.tree.mount(api, "/")
+    cherrypy.engine.start()
+    try:
+        cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+        elapsed = _roundTrips(MxRemoteClient(config), commands)
+        reconnecting = _roundTrips(MxRemoteClient(config, keepAlive=False), commands)
+    finally:
+        api._sessions.disconnect()
+        cherrypy.engine.exit()
+    return {
+        "commands" : commands,
+        "round_trip_us" : elapsed / commands * 1e6,
+        "commands_per_sec" : commands / elapsed,
+        "no_keepalive_round_trip_us" : reconnecting / commands * 1e6,
+        "keepalive_speedup" : reconnecting / elapsed,
+    }
+
+def benchParallel (config, sizes, jobs, commandsPerJob):
+    """ Jobs per second through an MxSessionPool of each size. """
+    def job (session, n):
+        for _ in range(commandsPerJob):
+            session.get.mcu.name()
+    results = {}
+    base = None
+    for size in sizes:
+        with MxSessionPool(config, size) as pool:
+            start = time.perf_counter()
+            pool.map(job, range(jobs))
+            elapsed = time.perf_counter() - start
+        rate = jobs / elapsed
+        base = rate if base is None else base
+        results[str(size)] = {
+            "seconds" : elapsed,
+            "jobs_per_sec" : rate,
+            "speedup" : rate / base,
+        }
+    return results
+
+Benchmarks = ("startup", "commands", "large_output", "server", "parallel")
+
+def benchSuite (startup = 1.0, latency = 0.005, commands = 500, largeLines = 100000,
+                poolSizes = (1, 2, 4), jobs = 16, commandsPerJob = 20, repeat = 3, only = None):
+    """
+    Runs the benchmarks against the fake CubeMX and returns the results as a
+    JSON-ready dict. 'only' limits the run to some of Benchmarks.
+    """
+    selected = Benchmarks if only is None else only
+    directory = tempfile.mkdtemp(prefix="pycubemx-bench-")
+    results = {
+        "meta" : {
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "cpus" : os.cpu_count(),
+            "parameters" : {
+                "startup" : startup, "latency" : latency, "commands" : commands,
+                "large_lines" : largeLines, "pool_sizes" : list(poolSizes), "jobs" : jobs,
+                "commands_per_job" : commandsPerJob, "repeat" : repeat,
+            },
+        },
+    }
+    try:
+        if "startup" in selected:
+            Log.info("Benchmark: startup")
+            results["startup"] = benchStartup(fakeConfig(directory, startup=startup), startup, repeat)
+        if "commands" in selected:
+            Log.info("Benchmark: commands")
+            results["commands"] = benchCommands(fakeConfig(directory), commands)
+        if "large_output" in selected:
+            Log.info("Benchmark: large_output")
+            config = fakeConfig(directory, output=["get pinout={}".format(largeLines)])
+            results["large_output"] = benchLargeOutput(config, largeLines, repeat)
+        if "server" in selected:
+            Log.info("Benchmark: server")
+            results["server"] = benchServer(fakeConfig(directory), commands)
+        if "parallel" in selected:
+            Log.info("Benchmark: parallel")
+            config = fakeConfig(directory, latency=latency)
+            results["parallel"] = benchParallel(config, poolSizes, jobs, commandsPerJob)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
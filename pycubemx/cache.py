@@ -0,0 +1,91 @@
+import logging
+import threading
+from collections import OrderedDict
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("MxQueryCache",)
+
+class MxQueryCache (object):
+    """
+    LRU cache for the raw responses of read-only ("query" effect) calls.
+    Hits are replayed through the call's Coder, so callers never share a
+    result object. Pass one to MxConnection(config, cache=...) to enable it;
+    the same cache can be shared by several sessions (e.g. an MxSessionPool).
+
+    Entries are keyed by CubeMX version, a fingerprint of the loaded project
+    and the command line. Any call that may change state moves the session's
+    fingerprint on and drops the entries of the old one.
+    """
+    def __init__ (self, maxEntries = 256, maxLines = 500000):
+        self.maxEntries = maxEntries
+        self.maxLines = maxLines
+        self._entries = OrderedDict()
+        self._lines = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _size (value):
+        try:
+            return max(1, len(value))
+        except TypeError:
+            return 1
+
+    def get (self, key):
+        """ Returns (found, value). """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def put (self, key, value):
+        size = self._size(value)
+        if size > self.maxLines:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._lines -= old[1]
+            self._entries[key] = (value, size)
+            self._lines += size
+            while len(self._entries) > self.maxEntries or self._lines > self.maxLines:
+                _, (_, dropped) = self._entries.popitem(last=False)
+                self._lines -= dropped
+                self.evictions += 1
+
+    def invalidate (self, fingerprint = None):
+        """ Drops entries for one project fingerprint, or everything if None. """
+        with self._lock:
+            if fingerprint is None:
+                keys = list(self._entries.keys())
+            else:
+                keys = [k for k in self._entries if k[1] == fingerprint]
+            for k in keys:
+                self._lines -= self._entries.pop(k)[1]
+            self.invalidations += len(keys)
+
+    def clear (self):
+        self.invalidate(None)
+
+    def __len__ (self):
+        return len(self._entries)
+
+    @property
+    def stats (self):
+        with self._lock:
+            return {
+                "entries" : len(self._entries),
+                "lines" : self._lines,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "invalidations" : self.invalidations,
+            }
@@ -4,17 +4,21 @@ import argparse
 import json
 import io
 import logging
+import pickle
+import hashlib
 from pathlib import Path
 import shutil
 
 __ALL__ = ('Config', 'ServerConfig', 'ConfigException',
-            'ServerConfig')
+            'ServerConfig', 'DaemonConfig')
 Log = logging.getLogger(__name__)
 
 DefaultDefinitionFile               = Path(os.path.dirname(__file__), "data", "cmd_db.json")
 DefaultTemplateFile                 = Path(os.path.dirname(__file__), "data", "default_config.json")
 DefaultLocalConfigDirectory         = Path(Path.home(), ".pycubemx")
 DefaultLocalConfigFile              = Path(DefaultLocalConfigDirectory, "config.json")
+DefaultDaemonDirectory              = Path(DefaultLocalConfigDirectory, "daemon")
+DefaultCacheDirectory               = Path(DefaultLocalConfigDirectory, "cache")
 """
 DefaultLocalServerConfigFile        = Path(DefaultLocalConfigDirectory, "server.json")
 DefaultLocalServerDataDirectory     = Path(DefaultLocalConfigDirectory, "server-data")
@@ -77,6 +81,79 @@ def _set (conf, key, value, onlyIfUndefined=False):
 
 class ConfigException(Exception): pass
 
+def _fileStamp (path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+def _fileDigest (path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+class _CompiledConfig (object):
+    """
+    The merged configuration of a set of source files, pickled so the next
+    start skips the JSON parsing and merging. A source whose mtime or size
+    changed is hashed, and only a different hash discards the cache.
+    """
+    Version = 1
+
+    def __init__ (self, sources, directory = DefaultCacheDirectory):
+        self.sources = [str(i) for i in sources]
+        key = repr((self.Version, sys.version_info[:2], self.sources))
+        self.path = Path(directory, hashlib.sha1(key.encode("utf8")).hexdigest()[:16] + ".pickle")
+        self._stamps = None
+
+    def _stamp (self):
+        # Taken before the sources are read, so an edit made while building
+        # is caught by the next start.
+        self._stamps = [_fileStamp(i) for i in self.sources]
+
+    def load (self):
+        try:
+            self._stamp()
+            with open(str(self.path), "rb") as f:
+                record = pickle.load(f)
+            if record["version"] != self.Version or [i[0] for i in record["sources"]] != self.sources:
+                return None
+        except Exception as e:
+            Log.debug("Compiled config unavailable: {}".format(e))
+            return None
+        restamped = False
+        for i, (path, mtime, size, digest) in enumerate(record["sources"]):
+            if self._stamps[i] == (mtime, size):
+                continue
+            if _fileDigest(path) != digest:
+                Log.debug("Compiled config stale: " + path)
+                return None
+            record["sources"][i] = (path,) + self._stamps[i] + (digest,)
+            restamped = True
+        if restamped:
+            self._write(record)
+        return record["config"]
+
+    def save (self, config):
+        if self._stamps is None:
+            return
+        try:
+            sources = [(path,) + stamp + (_fileDigest(path),) for path, stamp in zip(self.sources, self._stamps)]
+        except OSError:
+            return
+        self._write({"version" : self.Version, "sources" : sources, "config" : config})
+
+    def _write (self, record):
+        tmp = str(self.path) + ".{}.tmp".format(os.getpid())
+        try:
+            os.makedirs(str(self.path.parent), exist_ok=True)
+            with open(tmp, "wb") as f:
+                pickle.dump(record, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, str(self.path))
+        except OSError as e:
+            Log.debug("Unable to write compiled config: {}".format(e))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
 class Tool (object):
     def __init__ (self, name, config):
         self.name = name
@@ -94,6 +171,20 @@ class Tool (object):
     def command (self):
         return _get(self._config, "command", None)
 
+    @property
+    def startupTimeout (self):
+        return float(_get(self._config, "startup_timeout", 120.0))
+
+    @property
+    def commandTimeout (self):
+        """ Default deadline for one command in seconds; unset, null or 0 waits forever. """
+        value = _get(self._config, "command_timeout", None)
+        return float(value) if value else None
+
+    @property
+    def autoRestart (self):
+        return bool(_get(self._config, "auto_restart", True))
+
     @property
     def valid (self):
         return self.command is not None
@@ -124,15 +215,45 @@ class ServerConfig (object):
     def secret (self):
         return _get(self._config, ('secret',))
     @property
+    def sessions (self):
+        """ CubeMX sessions the server runs requests on. """
+        return int(_get(self._config, ('sessions',), 1))
+    @property
+    def decode (self):
+        """ Return typed records instead of raw lines for calls with a decoder. """
+        return bool(_get(self._config, ('decode',), False))
+    @property
     def uri (self):
         return "http://{self.host}:{self.port}/".format(self=self)
 
+class DaemonConfig (object):
+    def __init__ (self, config):
+        self._config = config
+    @property
+    def enabled (self):
+        return bool(_get(self._config, ('enabled',), True))
+    @property
+    def idleTimeout (self):
+        return float(_get(self._config, ('idle_timeout',), 900))
+    @property
+    def directory (self):
+        return Path(_get(self._config, ('directory',), str(DefaultDaemonDirectory)))
+    @property
+    def sessions (self):
+        """ CubeMX sessions the daemon runs requests on; each starts on first use. """
+        return int(_get(self._config, ('sessions',), min(4, os.cpu_count() or 1)))
+
 
 class Config (object):
     LocalConfigFile = str(DefaultLocalConfigFile)
 
     @classmethod
-    def LocalConfig (cls, configFile = None, nodefaults = False):
+    def LocalConfig (cls, configFile = None, nodefaults = False, cache = True):
+        """
+        Loads the built-in command schema merged with the user configuration.
+        With cache set the merged result is kept compiled on disk (see
+        _CompiledConfig) and reused while the source files are unchanged.
+        """
         c = cls ()
 
         Log.debug ("GetLocalConfig")
@@ -146,6 +267,15 @@ class Config (object):
                 os.makedirs(DefaultLocalConfigDirectory, exist_ok=True)
                 shutil.copy(str(DefaultTemplateFile), str(DefaultLocalConfigFile))
 
+        compiled = None
+        if cache:
+            compiled = _CompiledConfig(([] if nodefaults else [DefaultDefinitionFile]) + [configFile])
+            config = compiled.load()
+            if config is not None:
+                Log.debug("Loaded compiled config " + str(compiled.path))
+                c._config = config
+                return c
+
         if not nodefaults:
             Log.debug("Built-in command schema: Loading")
             c.loadFile(DefaultDefinitionFile, False)
@@ -155,6 +285,8 @@ class Config (object):
         Log.debug("Loading user config")
         c.loadFile(configFile)
 
+        if compiled is not None:
+            compiled.save(c._config)
         return c
 
     def __init__ (self):
@@ -216,6 +348,10 @@ class Config (object):
     def server (self):
         return ServerConfig(_get(self._config, ("server", ), {}))
 
+    @property
+    def daemon (self):
+        return DaemonConfig(_get(self._config, ("daemon", ), {}))
+
     #def tools (self):
     #    return _buildKVObjectSet(Tool, _get(self._config, "tools"))
 
@@ -0,0 +1,4 @@
+from .daemon import *
+from .client import *
+
+__ALL__ = ('MxDaemon', 'MxDaemonClient', 'MxDaemonException', 'daemonSocketPath')
@@ -0,0 +1,22 @@
+import logging
+import argparse
+from .daemon import MxDaemon
+from ..config import Config
+
+FORMAT = '%(asctime)s [%(name)-15s - %(levelname)-6s] %(message)s'
+logging.basicConfig(format=FORMAT,level=logging.INFO)
+Log = logging.getLogger('cubemx-daemon')
+
+parser = argparse.ArgumentParser(description='Background daemon holding a warm STM32CubeMX session.')
+parser.add_argument('--config', required=False,
+                    help='Overrides the local configuration file.\nDefault:' + Config.LocalConfigFile)
+parser.add_argument('--config-no-defaults', action='store_true',
+                    help='Don\'t load the default command set/settings.')
+parser.add_argument('--socket', required=False,
+                    help='Unix socket to listen on.')
+parser.add_argument('--idle-timeout', type=float, required=False,
+                    help='Seconds without requests before the daemon exits.')
+args = parser.parse_args()
+
+config = Config.LocalConfig (configFile = args.config, nodefaults = args.config_no_defaults)
+MxDaemon(config, socketPath=args.socket, idleTimeout=args.idle_timeout).run()
@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import subprocess
+from ..native import (MxException, MxCommandError, MxStatus, _buildNamespace, LogCubeLogs, LogCubeResp, LogCubeExec)
+from .daemon import daemonSocketPath
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ('MxDaemonClient', 'MxDaemonException')
+
+class MxDaemonException(MxException): pass
+
+class MxDaemonClient (object):
+    """
+    Drop-in for MxConnection that forwards calls to the per-user background
+    daemon, starting it on first use. The daemon keeps CubeMX warm between
+    invocations. configFile/nodefaults are passed on to a newly started
+    daemon so it loads the same configuration. The daemon's log is rotated
+    when a new daemon starts and it has grown past MaxLogSize bytes.
+    """
+    MaxLogSize = 1024 * 1024
+
+    def __init__ (self, config, configFile = None, nodefaults = False, startTimeout = 30.0, decode = False):
+        self._config = config
+        self._decode = decode
+        self._configFile = configFile
+        self._nodefaults = nodefaults
+        self._startTimeout = startTimeout
+        self._socketPath = daemonSocketPath(config)
+        self._sock = None
+        self._rfile = None
+        self._batch = None
+        config.configureLogger(LogCubeLogs)
+        config.configureLogger(LogCubeResp)
+        config.configureLogger(LogCubeExec)
+        config.configureLogger(Log)
+        self._ns = _buildNamespace(config, self)
+
+    @staticmethod
+    def available ():
+        return hasattr(socket, "AF_UNIX")
+
+    def __enter__ (self):
+        self.connect()
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.disconnect()
+
+    def _tryConnect (self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self._socketPath)
+        except OSError:
+            s.close()
+            return False
+        self._sock = s
+        self._rfile = s.makefile("rb")
+        return True
+
+    def _spawn (self):
+        directory = os.path.dirname(self._socketPath)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        cmd = [sys.executable, "-m", "pycubemx.daemon", "--socket", self._socketPath]
+        if self._configFile is not None:
+            cmd += ["--config", os.path.abspath(self._configFile)]
+        if self._nodefaults:
+            cmd += ["--config-no-defaults"]
+        Log.info("Starting daemon> " + " ".join(cmd))
+        env = dict(os.environ)
+        package = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env["PYTHONPATH"] = os.pathsep.join([package] + ([env["PYTHONPATH"]] if "PYTHONPATH" in env else []))
+        # The daemon outlives this process and serves every working directory,
+        # so callers should pass absolute paths (the CLI does).
+        logFile = self._socketPath[:-len(".sock")] + ".log"
+        if os.path.exists(logFile) and os.path.getsize(logFile) > self.MaxLogSize:
+            os.replace(logFile, logFile + ".1")
+        with open(logFile, "ab") as log:
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                             cwd=directory, env=env, start_new_session=True, close_fds=True)
+
+    def connect (self):
+        import fcntl
+        if self._sock is not None:
+            return
+        if self._tryConnect():
+            return
+        # Only one client starts the daemon; the others find it listening
+        # once they get the lock.
+        os.makedirs(os.path.dirname(self._socketPath), mode=0o700, exist_ok=True)
+        with open(self._socketPath + ".spawn", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self._tryConnect():
+                return
+            self._spawn()
+            deadline = time.monotonic() + self._startTimeout
+            while time.monotonic() < deadline:
+                time.sleep(0.05)
+                if self._tryConnect():
+                    return
+        raise MxDaemonException("Daemon did not start listening on " + self._socketPath)
+
+    def disconnect (self):
+        if self._sock is not None:
+            self._rfile.close()
+            self._sock.close()
+            self._sock = None
+            self._rfile = None
+
+    @property
+    def alive (self):
+        return self._sock is not None
+
+    def _request (self, req):
+        self.connect()
+        try:
+            self._sock.sendall(json.dumps(req).encode("utf-8") + b"\n")
+            line = self._rfile.readline()
+        except OSError as e:
+            self.disconnect()
+            raise MxDaemonException("Lost connection to daemon: " + str(e))
+        if len(line) == 0:
+            self.disconnect()
+            raise MxDaemonException("Daemon closed the connection.")
+        rc = json.loads(line.decode("utf-8"))
+        if rc["status"] != "success":
+            raise MxDaemonException("Daemon Exception: " + rc["exception"])
+        return rc
+
+    def stats (self):
+        """ The daemon's metrics, per session counters and session dispatch stats. """
+        return self._request({"op" : "stats"})["stats"]
+
+    def shutdownDaemon (self):
+        if self._tryConnect():
+            self._request({"op" : "shutdown"})
+            self.disconnect()
+            return True
+        return False
+
+    def __getattr__ (self, name):
+        return self._ns.__getattr__(name)
+
+    def _getcall (self, api):
+        return self._ns._lookup(api)
+
+    def _invoke (self, caller, args, timeout = None, force = False):
+        if self._batch is not None:
+            return self._batch._queue(caller, args)
+        rc = self._request({"api" : caller._key, "args" : list(args),
+                            "timeout" : timeout, "force" : force})
+        coder = caller.encode(args)
+        coder._replay(rc["data"], MxStatus[rc["mxstatus"]])
+        if coder.status in (MxStatus.MxTimeout, MxStatus.MxTerminated):
+            raise MxCommandError(coder.status, "Command '" + coder.command + "' did not complete.")
+        return caller._complete(coder)
+
+    def batch (self, stopOnError = False, window = 32):
+        from ..batch import MxBatch
+        return MxBatch(self, stopOnError=stopOnError, window=window)
+
+    def _transactMany (self, transacts, window = 32, stopOnError = False, timeout = None, calls = None):
+        # The daemon finds the callers again from the command lines.
+        rc = self._request({"op" : "batch", "commands" : [i.command for i in transacts],
+                            "window" : window, "stopOnError" : stopOnError,
+                            "timeout" : timeout})
+        for coder, result in zip(transacts, rc["results"]):
+            coder._replay(result["data"], MxStatus[result["mxstatus"]])
+
+    def _track (self, caller, command, args, status = MxStatus.MxOK):
+        # State is tracked by the daemon's own session.
+        pass
+
+    def dump (self, wrfunc = None, **kwargs):
+        if wrfunc is None:
+            wrfunc = lambda msg: Log.info(msg)
+        self._ns._dump(wrfunc=wrfunc, **kwargs)
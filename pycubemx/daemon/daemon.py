@@ -0,0 +1,186 @@
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import logging
+import threading
+import socketserver
+from ..native import MxConnection, Coder
+from ..metrics import MxMetrics
+from ..server.dispatch import MxSessionDispatcher
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ('MxDaemon', 'daemonSocketPath')
+
+def daemonSocketPath (config):
+    """ One daemon per user and distinct configuration. """
+    key = hashlib.sha1(json.dumps(config._config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(str(config.daemon.directory), key + ".sock")
+
+class _Handler (socketserver.StreamRequestHandler):
+    def handle (self):
+        daemon = self.server.daemon
+        # Calls over one connection run on one session, like an MxConnection.
+        key = uuid.uuid4().hex
+        try:
+            for line in self.rfile:
+                try:
+                    req = json.loads(line.decode("utf-8"))
+                    resp = daemon.handle(req, key)
+                except Exception as e:
+                    Log.exception("Request failed")
+                    resp = {"status" : "failure", "exception" : str(e)}
+                self.wfile.write(json.dumps(resp).encode("utf-8") + b"\n")
+                self.wfile.flush()
+        finally:
+            daemon._sessions.release(key)
+
+class _Server (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class MxDaemon (object):
+    """
+    Keeps warm CubeMX sessions behind a per-user unix socket so repeated
+    command line invocations skip CubeMX start-up. Requests are newline
+    delimited JSON. Each client connection runs on one session at a time,
+    and parallel clients (e.g. build jobs) run on up to 'sessions' sessions,
+    which start on first use. The daemon exits after idleTimeout seconds
+    without requests.
+    """
+    def __init__ (self, config, socketPath = None, idleTimeout = None, sessions = None):
+        self._config = config
+        self._socketPath = socketPath if socketPath is not None else daemonSocketPath(config)
+        self._idleTimeout = idleTimeout if idleTimeout is not None else config.daemon.idleTimeout
+        self._metrics = MxMetrics()
+        self._sessions = MxSessionDispatcher(config, sessions if sessions is not None else config.daemon.sessions,
+                                             metrics=self._metrics)
+        self._lock = threading.Lock()
+        self._lastActivity = time.monotonic()
+        self._active = 0
+        self._server = None
+
+    def _alreadyRunning (self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect(self._socketPath)
+            return True
+        except OSError:
+            return False
+        finally:
+            s.close()
+
+    def run (self):
+        import fcntl
+        directory = os.path.dirname(self._socketPath)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # Held for the daemon's lifetime: a second daemon for the socket
+        # gives up instead of replacing the first one's socket.
+        lock = open(self._socketPath + ".lock", "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            Log.info("Daemon already running on " + self._socketPath)
+            return
+        try:
+            self._serve()
+        finally:
+            lock.close()
+
+    def _serve (self):
+        if self._alreadyRunning():
+            Log.info("Daemon already running on " + self._socketPath)
+            return
+        if os.path.exists(self._socketPath):
+            os.unlink(self._socketPath)
+        self._server = _Server(self._socketPath, _Handler)
+        self._server.daemon = self
+        os.chmod(self._socketPath, 0o600)
+        Log.info("Listening on " + self._socketPath)
+        # Clients can connect already and wait in the backlog; warming up
+        # first means the first request finds the warm session free.
+        self._warm()
+        self._lastActivity = time.monotonic()
+        threading.Thread(target=self._idleWatch, daemon=True).start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            try:
+                os.unlink(self._socketPath)
+            except OSError:
+                pass
+            self._sessions.disconnect()
+            Log.info("Daemon stopped")
+
+    def _warm (self):
+        with self._sessions.lease() as session:
+            try:
+                session.connect()
+            except Exception:
+                Log.exception("Unable to start STM32CubeMX")
+
+    def _idleWatch (self):
+        while True:
+            time.sleep(min(5.0, max(0.1, self._idleTimeout / 4)))
+            with self._lock:
+                idle = self._active == 0 and (time.monotonic() - self._lastActivity) > self._idleTimeout
+            if idle:
+                Log.info("Idle for {}s, shutting down".format(self._idleTimeout))
+                self.shutdown()
+                return
+
+    def shutdown (self):
+        threading.Thread(target=self._server.shutdown, daemon=True).start()
+
+    def _run (self, session, api, args, timeout = None, force = False):
+        caller = session._getcall(api)
+        if caller is None or not caller._callable:
+            return {"status" : "failure", "exception" : "API not defined: " + api}
+        # Plain Coder so the client gets the raw lines and decodes them itself.
+        coder = Coder(caller.encode(args).command)
+        session._execute(caller, args, coder, timeout, force)
+        return {"status" : "success", "mxstatus" : coder.status.name, "data" : coder.data}
+
+    def _runMany (self, session, commands, window, stopOnError, timeout = None):
+        coders = [Coder(i) for i in commands]
+        session._transactMany(coders, window=window, stopOnError=stopOnError,
+                              timeout=timeout, calls=[session._resolve(i) for i in commands])
+        return {"status" : "success",
+                "results" : [{"mxstatus" : i.status.name, "data" : i.data} for i in coders]}
+
+    def stats (self):
+        """ Metrics of all sessions, each session's counters and the dispatcher's stats. """
+        return {
+            "metrics" : self._metrics.snapshot(),
+            "sessions" : [{k : v for k, v in i.stats().items() if k != "metrics"} for i in self._sessions.sessions],
+            "dispatch" : self._sessions.stats(),
+        }
+
+    def handle (self, req, key = None):
+        op = req.get("op", "call")
+        if op == "ping":
+            return {"status" : "success", "pid" : os.getpid()}
+        if op == "shutdown":
+            self.shutdown()
+            return {"status" : "success"}
+        if op == "stats":
+            return {"status" : "success", "stats" : self.stats()}
+        if op not in ("call", "batch"):
+            return {"status" : "failure", "exception" : "Unknown op: " + op}
+        with self._lock:
+            self._active += 1
+        try:
+            with self._sessions.lease(key) as session:
+                if op == "call":
+                    return self._run(session, req["api"], list(req.get("args", [])), req.get("timeout"),
+                                     req.get("force", False))
+                return self._runMany(session, req["commands"], req.get("window", 32),
+                                     req.get("stopOnError", False), req.get("timeout"))
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._lastActivity = time.monotonic()
@@ -0,0 +1,149 @@
+import abc
+import sys
+import logging
+from collections import namedtuple
+from .native import Coder, MxStatus
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("Pin", "Interrupt", "DmaRequest", "IpParameter",
+           "PinoutCoder", "InterruptCoder", "DmaRequestCoder", "IpParameterCoder",
+           "NameListCoder", "coderByName", "toJson")
+
+# Records are namedtuples: no per-instance dict, and the repeated strings
+# (signals, modes, peripheral names) are interned so each is held once.
+Pin         = namedtuple("Pin", ("pin", "signal", "label"))
+Interrupt   = namedtuple("Interrupt", ("name", "enabled", "priority", "subpriority"))
+DmaRequest  = namedtuple("DmaRequest", ("request", "channel", "params"))
+IpParameter = namedtuple("IpParameter", ("ip", "name", "value"))
+
+_intern = sys.intern
+_TRUE = frozenset(("true", "enabled", "enable", "yes"))
+_FALSE = frozenset(("false", "disabled", "disable", "no"))
+
+def _split (line, maxsplit = -1):
+    return [_intern(i) for i in line.split(None, maxsplit)]
+
+def _int (value):
+    try:
+        return int(value, 0)
+    except ValueError:
+        return None
+
+class _RecordCoder (Coder, metaclass=abc.ABCMeta):
+    """
+    Parses each line into a record as it arrives, so the raw lines are never
+    collected. The first Lookahead lines are held back until the status is
+    known: a failed call's reply (an error message) is left as raw lines
+    instead of being decoded. Lines that don't have the expected shape stay
+    in the result as raw strings, in order, and are also listed in
+    'unparsed'.
+    """
+    # CubeMX error replies are a line or two; a reply longer than this is
+    # taken to be data and decoded without waiting for the status.
+    Lookahead = 64
+
+    def __init__ (self, command):
+        super().__init__(command)
+        self.unparsed = []
+        self._held = []
+
+    def _receive (self, line):
+        held = self._held
+        if held is None:
+            self._decode(line)
+            return
+        held.append(line)
+        if len(held) > self.Lookahead:
+            # Too long for an error reply, decode from here on.
+            self._held = None
+            for i in held:
+                self._decode(i)
+
+    def _decode (self, line):
+        record = self._parse(line)
+        if record is not None:
+            self.data.append(record)
+        elif len(line.strip()) > 0:
+            self.data.append(line)
+            self.unparsed.append(line)
+
+    def processResult (self):
+        held, self._held = self._held, None
+        if held is not None:
+            if self.status == MxStatus.MxOK:
+                for i in held:
+                    self._decode(i)
+            else:
+                self.data.extend(held)
+        if len(self.unparsed) > 0:
+            Log.warning("{}: {} line(s) not decoded, returned as raw lines.".format(self.command, len(self.unparsed)))
+        return self.data
+
+    @abc.abstractmethod
+    def _parse (self, line):
+        """ The record for one line, or None if it doesn't have the expected shape. """
+
+class PinoutCoder (_RecordCoder):
+    """ get pinout: '<pin> <signal> [label]' per line. """
+    def _parse (self, line):
+        f = _split(line, 2)
+        if len(f) < 2:
+            return None
+        return Pin(f[0], f[1], f[2] if len(f) > 2 else None)
+
+class InterruptCoder (_RecordCoder):
+    """ nvic get_interrupts: '<irq> <enabled> [<priority> [<subpriority>]]' per line. """
+    def _parse (self, line):
+        f = _split(line)
+        if len(f) < 2 or len(f) > 4:
+            return None
+        state = f[1].lower()
+        if state not in _TRUE and state not in _FALSE:
+            return None
+        priorities = [_int(i) for i in f[2:]]
+        if None in priorities:
+            return None
+        priorities += [None] * (2 - len(priorities))
+        return Interrupt(f[0], state in _TRUE, priorities[0], priorities[1])
+
+class DmaRequestCoder (_RecordCoder):
+    """ dma list_all: '<request> <channel> [settings...]' per line. """
+    def _parse (self, line):
+        f = _split(line)
+        if len(f) < 2:
+            return None
+        return DmaRequest(f[0], f[1], tuple(f[2:]))
+
+class IpParameterCoder (_RecordCoder):
+    """ get ip parameters: '<ip> <name> [value]' per line. """
+    def _parse (self, line):
+        f = _split(line, 2)
+        if len(f) < 2:
+            return None
+        return IpParameter(f[0], f[1], f[2] if len(f) > 2 else None)
+
+class NameListCoder (_RecordCoder):
+    """ Name lists (peripherals, MCUs): one interned string per name. """
+    def _parse (self, line):
+        return _split(line)
+
+    def _decode (self, line):
+        self.data.extend(self._parse(line))
+
+_Coders = {i.__name__ : i for i in (Coder, PinoutCoder, InterruptCoder, DmaRequestCoder,
+                                    IpParameterCoder, NameListCoder)}
+
+def coderByName (name):
+    if name is None:
+        return Coder
+    if name not in _Coders:
+        Log.error("Unknown coder: " + name)
+        return Coder
+    return _Coders[name]
+
+def toJson (result):
+    """ Records as dicts, for JSON responses. """
+    if isinstance(result, list):
+        return [i._asdict() if hasattr(i, "_asdict") else i for i in result]
+    return result
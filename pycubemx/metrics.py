@@ -0,0 +1,172 @@
+import bisect
+import logging
+import threading
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("MxMetrics",)
+
+# Upper bounds in seconds; CubeMX calls range from sub-millisecond queries to
+# minutes of code generation.
+Buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+class Histogram (object):
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__ (self):
+        self.counts = [0] * (len(Buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe (self, value):
+        self.counts[bisect.bisect_left(Buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile (self, q):
+        """ Upper bound of the bucket holding the q-th observation. """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(Buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot (self):
+        return {
+            "count" : self.count,
+            "sum" : self.sum,
+            "mean" : self.sum / self.count if self.count > 0 else None,
+            "p50" : self.quantile(0.5),
+            "p90" : self.quantile(0.9),
+            "p99" : self.quantile(0.99),
+        }
+
+class _CommandStats (object):
+    __slots__ = ("calls", "lines", "bytes", "failures", "total", "firstLine", "decode")
+
+    def __init__ (self):
+        self.calls = 0
+        self.lines = 0
+        self.bytes = 0
+        self.failures = {}
+        self.total = Histogram()
+        self.firstLine = Histogram()
+        self.decode = Histogram()
+
+    def snapshot (self):
+        return {
+            "calls" : self.calls,
+            "lines" : self.lines,
+            "bytes" : self.bytes,
+            "failures" : dict(self.failures),
+            "total" : self.total.snapshot(),
+            "firstLine" : self.firstLine.snapshot(),
+            "decode" : self.decode.snapshot(),
+        }
+
+def _label (value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+class MxMetrics (object):
+    """
+    Per command path counters and latency histograms. Pass one to
+    MxConnection(config, metrics=...) to enable them; sessions without one
+    skip all of the bookkeeping. One instance can be shared by several
+    sessions.
+
+    Recorded per command path (e.g. 'config::load'): calls, total time,
+    time to the first response line, time spent decoding the result, lines
+    and bytes received and failures by MxStatus. Session start-up and
+    recovery times are recorded too.
+    """
+    def __init__ (self):
+        self._lock = threading.Lock()
+        self._commands = {}
+        self.startup = Histogram()
+        self.recovery = Histogram()
+
+    def _get (self, path):
+        stats = self._commands.get(path)
+        if stats is None:
+            stats = self._commands[path] = _CommandStats()
+        return stats
+
+    def command (self, path, status, total, firstLine, lines, nbytes):
+        with self._lock:
+            stats = self._get(path)
+            stats.calls += 1
+            stats.lines += lines
+            stats.bytes += nbytes
+            stats.total.observe(total)
+            if firstLine is not None:
+                stats.firstLine.observe(firstLine)
+            if not status:
+                stats.failures[status.name] = stats.failures.get(status.name, 0) + 1
+
+    def decode (self, path, seconds):
+        with self._lock:
+            self._get(path).decode.observe(seconds)
+
+    def started (self, seconds):
+        with self._lock:
+            self.startup.observe(seconds)
+
+    def recovered (self, seconds):
+        with self._lock:
+            self.recovery.observe(seconds)
+
+    def reset (self):
+        with self._lock:
+            self._commands = {}
+            self.startup = Histogram()
+            self.recovery = Histogram()
+
+    def snapshot (self):
+        with self._lock:
+            return {
+                "startup" : self.startup.snapshot(),
+                "recovery" : self.recovery.snapshot(),
+                "commands" : {k : v.snapshot() for k, v in sorted(self._commands.items())},
+            }
+
+    def prometheus (self, prefix = "pycubemx"):
+        """ The metrics in the Prometheus text exposition format. """
+        out = []
+        def histogram (name, help, items):
+            out.append("# HELP {}_{} {}".format(prefix, name, help))
+            out.append("# TYPE {}_{} histogram".format(prefix, name))
+            for labels, h in items:
+                sep = "," if labels else ""
+                seen = 0
+                for bound, n in zip(Buckets, h.counts):
+                    seen += n
+                    out.append("{}_{}_bucket{{{}{}le=\"{}\"}} {}".format(prefix, name, labels, sep, bound, seen))
+                out.append("{}_{}_bucket{{{}{}le=\"+Inf\"}} {}".format(prefix, name, labels, sep, h.count))
+                braces = "{" + labels + "}" if labels else ""
+                out.append("{}_{}_sum{} {}".format(prefix, name, braces, h.sum))
+                out.append("{}_{}_count{} {}".format(prefix, name, braces, h.count))
+        def counter (name, help, items):
+            out.append("# HELP {}_{} {}".format(prefix, name, help))
+            out.append("# TYPE {}_{} counter".format(prefix, name))
+            for labels, value in items:
+                out.append("{}_{}{{{}}} {}".format(prefix, name, labels, value))
+
+        with self._lock:
+            commands = [("command=\"{}\"".format(_label(k)), v) for k, v in sorted(self._commands.items())]
+            histogram("startup_seconds", "STM32CubeMX start-up time.", [("", self.startup)])
+            histogram("recovery_seconds", "Session restart and replay time.", [("", self.recovery)])
+            histogram("command_seconds", "Command round trip time.", [(l, v.total) for l, v in commands])
+            histogram("command_first_line_seconds", "Time to the first response line.",
+                      [(l, v.firstLine) for l, v in commands])
+            histogram("command_decode_seconds", "Time spent decoding results.", [(l, v.decode) for l, v in commands])
+            counter("command_calls_total", "Commands run.", [(l, v.calls) for l, v in commands])
+            counter("command_lines_total", "Response lines received.", [(l, v.lines) for l, v in commands])
+            counter("command_bytes_total", "Response bytes received.", [(l, v.bytes) for l, v in commands])
+            counter("command_failures_total", "Failed commands by status.",
+                    [("{},status=\"{}\"".format(l, s), n) for l, v in commands for s, n in sorted(v.failures.items())])
+        return "\n".join(out) + "\n"
@@ -10,6 +10,11 @@ import time
 from enum import Enum
 import select
 import fcntl
+import tempfile
+import hashlib
+import threading
+import collections
+from .trace import active as _activeTrace
 
 Log = logging.getLogger(__name__)
 LogCubeLogs = logging.getLogger("native.log")
@@ -38,32 +43,56 @@ class MxStatus (Enum):
     MxUnprocessed       = "Command Incomplete"
     MxBadState          = "Bad State (IPC)"
     MxConnectError      = "Bad State (IPC)"
+    MxTimeout           = "Timeout"
 
     def __bool__ (self):
         return (self == MxStatus.MxOK)
 
 class Coder (object):
-    _RE_END = re.compile("^.*(\d+)\s+(OK|KO)\s*$")
+    # Kept for code that matched end lines with it; _emit uses _isEnd.
+    _RE_END = re.compile(r"^.*(\d+)\s+(OK|KO)\s*$")
 
     def __init__ (self, command):
         self.data       = []
         self.status     = MxStatus.MxUnprocessed
         self.command    = command
         self.result     = None
+        self.tee        = None  # set to a list to also capture the raw response lines
+
+    @staticmethod
+    def _isEnd (line):
+        # Same as matching r".*\d+\s+(OK|KO)$" against an rstripped line,
+        # without the regex backtracking over the whole line.
+        head = line[:-2]
+        stripped = head.rstrip()
+        return len(stripped) < len(head) and stripped[-1:].isdigit()
 
     def _emit (self, line):
-        m = self._RE_END.match(line)
-        if m:
-            if m.group(2) == "OK":
+        tail = line[-2:]
+        if (tail == "OK" or tail == "KO") and self._isEnd(line):
+            if tail == "OK":
                 self.status = MxStatus.MxOK
             else:
                 self.status = MxStatus.MxError
             LogCubeExec.debug("(exitcond) " + self.status.name)
             return True
         else:
-            self.data.append(line)
+            if self.tee is not None:
+                self.tee.append(line)
+            self._receive(line)
             return False
 
+    def _replay (self, lines, status):
+        """ Fills in the response from previously captured raw lines. """
+        for line in lines:
+            if self.tee is not None:
+                self.tee.append(line)
+            self._receive(line)
+        self.status = status
+
+    def _receive (self, line):
+        self.data.append(line)
+
     @property
     def done(self):
         return self.status != MxStatus.MxUnprocessed
@@ -89,16 +118,111 @@ class Coder (object):
     def __str__ (self):
         return "Command<" + self.command + ">"
 
+class MxStream (object):
+    """
+    Iterates over a command's results while CubeMX is still producing them.
+    Only the current item is held in memory. Closing the stream early reads
+    and discards the remainder so the session stays usable; starting another
+    command on the session does the same.
+    """
+    def __init__ (self, coder, exchange):
+        self._coder = coder
+        self._exchange = exchange
+
+    @property
+    def command (self):
+        return self._coder.command
+
+    @property
+    def status (self):
+        return self._coder.status
+
+    def chunks (self):
+        """ Yields the results in lists, as each read from CubeMX completes them. """
+        coder = self._coder
+        for _ in self._exchange:
+            if len(coder.data) > 0:
+                items, coder.data = coder.data, []
+                yield items
+        # Decoders hold back the first lines until the status is known.
+        items = coder.finish()
+        if len(items) > 0:
+            coder.data = []
+            yield items
+
+    def __iter__ (self):
+        for items in self.chunks():
+            for i in items:
+                yield i
+
+    def close (self):
+        self._exchange.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.close()
+
+class MxSpool (object):
+    """ A completed command's output lines, spilled to a temporary file past maxMemory bytes. """
+    def __init__ (self, stream, maxMemory):
+        self.command = stream.command
+        self._file = tempfile.SpooledTemporaryFile(max_size=maxMemory, mode="w+", encoding=Encoding)
+        self.count = 0
+        try:
+            for line in stream:
+                self._file.write(line)
+                self._file.write("\n")
+                self.count += 1
+        finally:
+            stream.close()
+        self.status = stream.status
+
+    @property
+    def rolledOver (self):
+        return self._file._rolled
+
+    def __iter__ (self):
+        self._file.seek(0)
+        for line in self._file:
+            yield line[:-1]
+
+    def __len__ (self):
+        return self.count
+
+    def close (self):
+        self._file.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.close()
+
 class Caller (object):
-    def __init__ (self, name, argcount, coder = Coder, help = None):
+    # effect: "query" for calls that only read CubeMX state, "load" for calls
+    # that replace the loaded project, "action" for calls whose effect is
+    # outside the session (generating, saving, exiting), None (the default)
+    # for anything that may change state.
+    # stateKey names the piece of session state the call sets (e.g. the
+    # loaded project or the toolchain) so a call that would not change it
+    # can be skipped.
+    __slots__ = ("_parent", "_top", "_path", "_key", "_name", "_oname", "_argcount", "_help",
+                 "_coder", "_effect", "_stateKey", "_echo")
+
+    def __init__ (self, name, argcount, coder = Coder, help = None, effect = None, stateKey = None):
         self._parent = None
         self._top = None
         self._path = None
+        self._key = None
         self._name = name.replace(" ", "_")
         self._oname = name
         self._argcount = argcount
         self._help = help
         self._coder = coder
+        self._effect = effect
+        self._stateKey = stateKey
         self._echo = False
 
     @property
@@ -111,16 +235,27 @@ class Caller (object):
             self._path = self._parent._path + [self._name]
         else:
             self._path = []
+        self._key = "::".join(self._path)
 
     def encode (self, args):
         if len(args) != self._argcount:
             raise MxException("Mismatched argument count. Got {} expected {}".format(len(args), self._argcount))
-        return Coder(" ".join(list(self._path) + list(args)))
+        # Typed decoding is opt-in per session (decode=True); raw lines otherwise.
+        coder = self._coder if self._top._decode else Coder
+        return coder(" ".join(list(self._path) + list(args)))
+
+    def __call__ (self, *args, **kwargs):
+        return self._top._invoke(self, args, **kwargs)
+
+    def stream (self, *args, timeout = None):
+        """ Like calling, but returns an MxStream that yields results as CubeMX produces them. """
+        return self._top._stream(self.encode(args), self, args, timeout=timeout)
 
-    def __call__ (self, *args):
-        coder = self.encode(args)
-        self._top._transact(coder)
+    def spool (self, *args, maxMemory = 1024*1024, timeout = None):
+        """ Runs the call, holding output in memory up to maxMemory bytes and in a temp file beyond. """
+        return MxSpool(self._top._stream(Coder(self.encode(args).command), self, args, timeout=timeout), maxMemory)
 
+    def _complete (self, coder):
         try:
             return coder.finish()
         except Exception as e:
@@ -132,14 +267,18 @@ class Caller (object):
             raise MxCommandError(coder.status, "Command '" + coder.command + "' failed.")
 
     def __str__ (self):
-        return "(C) " + "::".join(self._path) + "(argcount={})".format(self._argcount)
+        return "(C) " + self._key + "(argcount={})".format(self._argcount)
 
     def _dump (self, wrfunc, *args, includeHelp = False, **kwargs):
+        for line in self._lines(includeHelp):
+            wrfunc(line)
+
+    def _lines (self, includeHelp = False):
         prefix = "".ljust((len(self._path)*4))
-        wrfunc(prefix + str(self))
+        yield prefix + str(self)
         if (includeHelp):
             if self._help:
-                wrfunc(prefix + "    >> " + self._help)
+                yield prefix + "    >> " + self._help
 
     def _serialize (self):
         ser = {
@@ -149,21 +288,36 @@ class Caller (object):
             "help" : self._help,
             "argcount" : self._argcount
         }
+        if self._effect is not None:
+            ser["effect"] = self._effect
+        if self._stateKey is not None:
+            ser["state_key"] = self._stateKey
+        if self._coder is not Coder:
+            ser["coder"] = self._coder.__name__
         return ser
     @staticmethod
     def _deserialize (entry):
-        caller = Caller(entry['oname'], entry['argcount'], help=entry["help"])
+        from .decoders import coderByName
+        caller = Caller(entry['oname'], entry['argcount'], coder=coderByName(entry.get("coder")),
+                        help=entry["help"], effect=entry.get("effect"), stateKey=entry.get("state_key"))
         return caller
 
 class Namespace (object):
-    def __init__ (self, name, *args, help = None):
+    # Children given as serialized schema entries are only built on first
+    # access, so a session pays for the parts of the command tree it uses.
+    __slots__ = ("_parent", "_path", "_top", "_name", "_oname", "_help", "_nodes", "_entries",
+                 "_index", "_isRoot")
+
+    def __init__ (self, name, *args, help = None, entries = None):
         self._parent = None
         self._path = []
         self._top = None
         self._name = name.replace(" ", "_")
         self._oname = name
         self._help = help
-        self._children = {}
+        self._nodes = {}
+        self._entries = entries
+        self._index = None
         self._isRoot = False
         for i in args:
             self._addChild(i)
@@ -173,14 +327,55 @@ class Namespace (object):
             self._path = self._parent._path + [self._name]
         else:
             self._path = []
-        for i in self._children.values():
+        for i in self._nodes.values():
             i.set_top(top)
     @property
     def _callable (self):
         return False
+    @property
+    def _children (self):
+        if self._entries is not None:
+            self._materialize()
+        return self._nodes
+    def _materialize (self):
+        # Sessions are used from several threads (e.g. the server looks calls
+        # up without a lease): build the children aside and publish them
+        # with one assignment, before _entries is cleared. Two threads may
+        # both build them; either result is complete.
+        entries = self._entries
+        if entries is None:
+            return
+        nodes = dict(self._nodes)
+        for i in entries:
+            if i["type"] == "Namespace":
+                c = Namespace._deserialize(i)
+            elif i["type"] == "Caller":
+                c = Caller._deserialize(i)
+            else:
+                Log.error("Unknown type: {}".format(i))
+                continue
+            nodes[c._name] = c
+            c._parent = self
+            c.set_top(self._top)
+        self._nodes = nodes
+        self._entries = None
     def _addChild (self, command):
         self._children[command._name] = command
         command._parent = self
+    def _lookup (self, api):
+        """ The node at api ("a::b::c" or a list of names) below this one, or None. """
+        key = api if isinstance(api, str) else "::".join(api)
+        if self._index is None:
+            self._index = {}
+        node = self._index.get(key)
+        if node is None:
+            node = self
+            for i in key.split("::") if key else ():
+                node = node._getChild(i)
+                if node is None:
+                    return None
+            self._index[key] = node
+        return node
     @property
     def _childNamespaces (self):
         lst = []
@@ -204,58 +399,191 @@ class Namespace (object):
         return None
 
     def __getattr__(self, name):
-        if name in self._children:
-            return self._children[name]
+        node = self._children.get(name)
+        if node is not None:
+            return node
         raise AttributeError("Attr " + name + " does not exist.")
 
     def __str__ (self):
         return "(N) " + "::".join(self._path)
 
     def _dump (self, wrfunc, includeHelp = False, *args, **kwargs):
+        for line in self._lines(includeHelp):
+            wrfunc(line)
+
+    def _lines (self, includeHelp = False):
+        """ The _dump listing one line at a time. """
         prefix = "".ljust(len(self._path)*4)
         if (self._isRoot):
-            wrfunc(prefix + "<Root>")
+            yield prefix + "<Root>"
         else:
-            wrfunc(prefix + str(self))
+            yield prefix + str(self)
         if (includeHelp):
             if self._help is not None:
-                wrfunc(prefix + "  " + self._help)
+                yield prefix + "  " + self._help
         cns = self._childNamespaces
         ccall = self._childCalls
         if len(cns) > 0:
-            wrfunc(prefix + "  [Namespaces]")
+            yield prefix + "  [Namespaces]"
             for v in cns:
-                v._dump(*args,includeHelp=includeHelp,wrfunc=wrfunc,**kwargs)
+                yield from v._lines(includeHelp)
         if len(ccall) > 0:
-            wrfunc(prefix + "  [Calls]")
+            yield prefix + "  [Calls]"
             for v in ccall:
-                v._dump(*args,includeHelp=includeHelp,wrfunc=wrfunc,**kwargs)
+                yield from v._lines(includeHelp)
     def _serialize (self):
+        if self._entries is not None:
+            children = list(self._entries)
+        else:
+            children = list ([i._serialize() for i in self._nodes.values()])
         ser = {
             "type" : "Namespace",
             "name" : self._name,
             "oname" : self._oname,
             "help" : self._help,
-            "children" : list ([i._serialize() for i in self._children.values()])
+            "children" : children
         }
         return ser
     @staticmethod
     def _deserialize (entry):
-        ns = Namespace(entry['oname'], help=entry["help"])
-        for i in entry['children']:
-            if i["type"] == "Namespace":
-                c = Namespace._deserialize(i)
-            elif i["type"] == "Caller":
-                c = Caller._deserialize(i)
-            else:
-                Log.error("Unknown type: {}".format(i))
-                continue
-            ns._addChild(c)
-        return ns
+        return Namespace(entry['oname'], help=entry["help"], entries=entry['children'])
 
 def qmode (*argsnames):
     return list([Arg(i) for i in argsnames])
 
+def _buildNamespace (config, top):
+    x = config._apiSchema
+    if x is not None:
+        ns = Namespace._deserialize(x)
+    else:
+        # Implement the bare essentials for the command set (if not provided)
+        ns = Namespace("",
+            Caller("help",0),
+            Caller("exit",0),
+        )
+    ns.set_top(top)
+    ns._isRoot = True
+    return ns
+
+def _scanPrompt (pending, chunk):
+    """ Splits startup output into lines; returns (ready, pending) once the MX> prompt shows up. """
+    lines = (pending + chunk).split(b"\n")
+    pending = lines.pop()
+    for line in lines:
+        line = line.decode(Encoding, "replace").rstrip()
+        if MxConnection.RE_ACCEPT_CMDS.match(line):
+            return True, b""
+        LogCubeLogs.debug("(log) " + line)
+    if MxConnection.RE_ACCEPT_CMDS.match(pending.decode(Encoding, "replace")):
+        return True, b""
+    return False, pending
+
+def _digestFile (path):
+    """ sha1 of a file's contents, or None if it can't be read. """
+    h = hashlib.sha1()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    return h.hexdigest()
+
+def _drainStderr (pipe, tail):
+    # Nobody reads stderr otherwise; a full pipe would stall CubeMX. The last
+    # few lines are kept to explain a crash or hang.
+    for line in iter(pipe.readline, b""):
+        line = line.decode(Encoding, "replace").rstrip()
+        tail.append(line)
+        LogCubeLogs.debug("(stderr) " + line)
+
+def _feedLine (transact, line):
+    """ Routes one line of CubeMX output to the log or to the pending command. Returns True for log lines. """
+    line = line.rstrip()
+    first = line[:1]
+    # Log lines start with a timestamp, the prompt with 'M'. Only run the
+    # full patterns when the first character says it could match.
+    if "0" <= first <= "9" and MxConnection._RE_LOGITEM.match(line):
+        if LogCubeLogs.isEnabledFor(logging.DEBUG):
+            LogCubeLogs.debug("(log) " + line)
+        return True
+    elif first == "M" and MxConnection.RE_ACCEPT_CMDS.match(line):
+        return
+    else:
+        if LogCubeResp.isEnabledFor(logging.DEBUG):
+            LogCubeResp.debug("(recv) " + line)
+        transact._emit(line)
+
+class _PipeReader (object):
+    """
+    Line reader over the raw CubeMX stdout pipe. Output is pulled with bulk
+    non-blocking os.read() calls into one buffer that is compacted and reused,
+    rather than going through a BufferedReader line at a time.
+    """
+    def __init__ (self, fd, chunkSize = 65536):
+        self._fd = fd
+        self._chunkSize = chunkSize
+        self._buf = bytearray()
+        self._pos = 0
+        self.eof = False
+        fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+
+    def _fill (self, deadline = None):
+        # Returns False on EOF.
+        while True:
+            try:
+                chunk = os.read(self._fd, self._chunkSize)
+            except BlockingIOError:
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        raise TimeoutError("Timed out waiting for STM32CubeMX output.")
+                select.select([self._fd], [], [], timeout)
+                continue
+            if len(chunk) == 0:
+                self.eof = True
+                return False
+            if self._pos > 0 and self._pos >= (len(self._buf) >> 1):
+                del self._buf[:self._pos]
+                self._pos = 0
+            self._buf += chunk
+            return True
+
+    def readchunk (self, deadline = None):
+        """ Returns whatever is buffered or next available; b"" on EOF. """
+        if self._pos == len(self._buf) and not self._fill(deadline):
+            return b""
+        chunk = bytes(self._buf[self._pos:])
+        del self._buf[:]
+        self._pos = 0
+        return chunk
+
+    @property
+    def hasLine (self):
+        """ Whether a complete line is buffered, so readline() returns without reading. """
+        return self._buf.find(b"\n", self._pos) >= 0
+
+    def readline (self, deadline = None):
+        """ Returns the next line without its newline, or None on EOF. """
+        buf = self._buf
+        idx = buf.find(b"\n", self._pos)
+        while idx < 0:
+            scanned = len(buf) - self._pos
+            if not self._fill(deadline):
+                if self._pos < len(buf):
+                    # Unterminated last line.
+                    line = buf[self._pos:].decode(Encoding, "replace")
+                    self._pos = len(buf)
+                    return line
+                return None
+            buf = self._buf
+            idx = buf.find(b"\n", self._pos + scanned)
+        line = buf[self._pos:idx].decode(Encoding, "replace")
+        self._pos = idx + 1
+        return line
+
 class MxConnection (object):
     _RE_LOGITEM=re.compile(r'\d+-\d+-\d+\s+\d+:\d+:\d+,\d+\s+\[\w+\].*')
     _NOT_CONNECTED = 0
@@ -264,32 +592,49 @@ class MxConnection (object):
     _BSY = 3
     _CONNECTION_DROPPED = 4
 
-    RE_ACCEPT_CMDS = re.compile("^MX>\s*$")
+    RE_ACCEPT_CMDS = re.compile(r"^MX>\s*$")
 
-    def __init__ (self, config):
+    def __init__ (self, config, cache = None, metrics = None, tracer = None, record = None, decode = False):
         self._config = config
+        self._decode = decode
         self._proc = None
         self._st = self._NOT_CONNECTED
         self._sout = None
         self._sin = None
         self._serr = None
         self._cubemx = None# self._config.tool("stm32cubemx")
+        self.startupTime = None
+        self._batch = None
+        self._openStream = None
+        self._reader = None
+        self._cache = cache
+        self._metrics = metrics
+        self._tracer = tracer
+        self._recorder = None
+        self._ownRecorder = False
+        if record is not None:
+            from .transcript import TranscriptWriter
+            self._ownRecorder = not isinstance(record, TranscriptWriter)
+            self._recorder = TranscriptWriter(record) if self._ownRecorder else record
+        self._mxVersion = None
+        self._fingerprint = ""
+        self._journal = []
+        self._state = {}
+        self.elided = 0
+        self._stderrTail = collections.deque(maxlen=20)
+        tool = config.STM32CubeMX
+        self._commandTimeout = tool.commandTimeout
+        self._autoRestart = tool.autoRestart
+        self.timeouts = 0
+        self.restarts = 0
+        self.recoveryTime = 0.0
+        self.lastRecoveryTime = None
         config.configureLogger(LogCubeLogs)
         config.configureLogger(LogCubeResp)
         config.configureLogger(LogCubeExec)
         config.configureLogger(Log)
 
-        x = config._apiSchema
-        if x is not None:
-            self._ns = Namespace._deserialize(x)
-        else:
-            # Implement the bare essentials for the command set (if not provided)
-            self._ns = Namespace("",
-                Caller("help",0),
-                Caller("exit",0),
-            )
-        self._ns.set_top(self)
-        self._ns._isRoot = True
+        self._ns = _buildNamespace(config, self)
 
     def __del__ (self):
         self.disconnect()
@@ -303,9 +648,17 @@ class MxConnection (object):
         #Log.debug("**EXIT**")
         self.disconnect()
 
+    @property
+    def alive (self):
+        """True if the CubeMX process is running and able to take commands."""
+        if self._proc is None or self._st in (self._NOT_CONNECTED, self._CONNECTION_DROPPED):
+            return False
+        return self._proc.poll() is None
+
     def disconnect (self):
         Log.info("Disconnecting")
         if self._proc is not None:
+            self._closeStream()
             try:
                 if self._st != self._CONNECTION_DROPPED:
                     Log.info("Waiting for exit")
@@ -325,9 +678,13 @@ class MxConnection (object):
             except:
                 Log.exception("OTHER EXCEPTION")
             self._proc = None
-            self._st = self._NOT_CONNECTED
+            self._reader = None
+        # A writer passed in by the caller is theirs to close.
+        if self._ownRecorder:
+            self._recorder.close()
+        self._st = self._NOT_CONNECTED
 
-    def connect (self):
+    def connect (self, timeout = None):
         if self._st == self._CONNECTION_DROPPED:
             self.disconnect()
 
@@ -339,49 +696,68 @@ class MxConnection (object):
         try:
             if self._cubemx.valid is False:
                 raise MxException("STM32CubeMX tool not found.")
+            if timeout is None:
+                timeout = self._cubemx.startupTimeout
             cmd = [self._cubemx.command] + list(self._cubemx.arguments) + ["-s"]
             Log.info(">> " + " ".join(cmd))
 
             Log.info("Connecting> " + " ".join(cmd))
-            self._proc = Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+            started = time.monotonic()
+            tracer, traceId = self._tracing()
+            traceStart = tracer.now() if tracer is not None else None
+            self._proc = self._spawn(cmd)
+            self._reader = _PipeReader(self._proc.stdout.fileno())
+            # A new tail per process, before its drain starts, so no early
+            # lines are lost and a previous process can't add to it.
+            self._stderrTail = collections.deque(maxlen=20)
+            threading.Thread(target=_drainStderr, args=(self._proc.stderr, self._stderrTail),
+                             daemon=True).start()
             self._st = self._IDLE_NOT_RDY
+            self._mxVersion = None
+            self._fingerprint = ""
+            self._state = {}
 
             Log.info("Waiting until session ready...")
-
-            fd = self._proc.stdout.fileno()
-            florig = fcntl.fcntl(fd, fcntl.F_GETFL)
-            fcntl.fcntl(fd, fcntl.F_SETFL, florig | os.O_NONBLOCK)
-            while True:
-                sel = select.select([self._proc.stdout], [], [], 2.0)
-                if len(sel[0]) == 0:
-                    # Think we're good...
-                    break
-                else:
-                    self._proc.stdout.read(1024) # discard content
-            fcntl.fcntl(fd, fcntl.F_SETFL, florig)
+            self._waitForPrompt(started + timeout)
             self._st = self._IDLE_RDY
-            """while True:
-                line = self._proc.stdout.readline().decode(Encoding)
-                LogCubeLogs.debug ("(log)" + line)
-                if len(line) == 0:
-                    self._st = self._CONNECTION_DROPPED
-                    transact.fail(MxStatus.MxConnectError)
-                    return
-                else:
-                    if "MX>" in line: # indicator that it is ready to process commands
-                        self._st = self._IDLE_RDY
-                        break"""
-
-            time.sleep(0.2)
-            Log.info("Session Ready!")
+            self.startupTime = time.monotonic() - started
+            if self._metrics is not None:
+                self._metrics.started(self.startupTime)
+            if tracer is not None:
+                tracer.complete("connect", traceStart, traceId, command=" ".join(cmd))
+            if self._recorder is not None:
+                self._recorder.start(" ".join(cmd), self.startupTime)
+            Log.info("Session Ready! ({:.3f}s)".format(self.startupTime))
         except FileNotFoundError as e:
             Log.error("Unable to locate STM32CubeMX executable.")
             raise MxException("STM32CubeMX cannot be executed.")
+        except MxException:
+            self.disconnect()
+            raise
         except:
             Log.exception("Error occured while initializing session...")
             self.disconnect()
             raise MxException("STM32CubeMX cannot be executed.")
 
+    def _spawn (self, cmd):
+        return Popen(cmd, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+
+    def _waitForPrompt (self, deadline):
+        # The prompt may arrive without a trailing newline, so read whatever
+        # is available rather than waiting for a line.
+        pending = b""
+        while True:
+            try:
+                chunk = self._reader.readchunk(deadline)
+            except TimeoutError:
+                raise MxException("STM32CubeMX did not become ready in time.")
+            if len(chunk) == 0:
+                self._st = self._CONNECTION_DROPPED
+                raise MxException("STM32CubeMX exited before it was ready.")
+            ready, pending = _scanPrompt(pending, chunk)
+            if ready:
+                return
+
     def __getattr__(self, name):
         return self._ns.__getattr__(name)
 
@@ -415,30 +791,436 @@ class MxConnection (object):
 
         return nscur
 
-    def _transact (self, transact):
-        Log.debug("mx exec>> " + transact.command)
-        if self._st == self._NOT_CONNECTED:
+    def _invoke (self, caller, args, timeout = None, force = False):
+        if self._batch is not None:
+            return self._batch._queue(caller, args)
+        coder = caller.encode(args)
+        self._execute(caller, args, coder, timeout, force)
+        if coder.status in (MxStatus.MxTimeout, MxStatus.MxTerminated):
+            raise MxCommandError(coder.status, "Command '" + coder.command + "' did not complete.")
+        tracer, traceId = self._tracing()
+        if self._metrics is None and tracer is None:
+            return caller._complete(coder)
+        started = time.monotonic()
+        traceStart = tracer.now() if tracer is not None else None
+        try:
+            return caller._complete(coder)
+        finally:
+            if self._metrics is not None:
+                self._metrics.decode(caller._key, time.monotonic() - started)
+            if tracer is not None:
+                tracer.complete("decode", traceStart, traceId, command=coder.command)
+
+    def _execute (self, caller, args, coder, timeout = None, force = False):
+        """ Runs one call, leaving the response in coder. """
+        if not force and self._elide(caller, args, coder):
+            return
+        if self._cache is not None and caller._effect == "query":
+            self._cachedExecute(caller, args, coder, timeout)
+            return
+        self._transact(coder, timeout)
+        self._track(caller, coder.command, args, coder.status)
+
+    def _cachedExecute (self, caller, args, coder, timeout = None):
+        self._ready()
+        key = (self._version(), self._fingerprint, coder.command)
+        found, lines = self._cache.get(key)
+        if found:
+            coder._replay(lines, MxStatus.MxOK)
+            return
+        tee, coder.tee = coder.tee, []
+        try:
+            self._transact(coder, timeout)
+            if coder.status == MxStatus.MxOK:
+                self._cache.put(key, tuple(coder.tee))
+        finally:
+            if tee is not None:
+                tee.extend(coder.tee)
+            coder.tee = tee
+
+    def stats (self):
+        """ Session counters, plus per command metrics when enabled. """
+        stats = {
+            "startupTime" : self.startupTime,
+            "restarts" : self.restarts,
+            "recoveryTime" : self.recoveryTime,
+            "timeouts" : self.timeouts,
+            "elided" : self.elided,
+        }
+        if self._cache is not None:
+            stats["cache"] = self._cache.stats
+        if self._metrics is not None:
+            stats["metrics"] = self._metrics.snapshot()
+        return stats
+
+    def _tracing (self):
+        """ The tracer activated on this thread, else the session's own. """
+        tracer, traceId = _activeTrace()
+        if tracer is None:
+            return self._tracer, None
+        return tracer, traceId
+
+    def _resolve (self, command):
+        """ Finds the caller and arguments a command line was built from. """
+        words = command.split(" ")
+        for i in range(1, len(words) + 1):
+            node = self._ns._lookup(words[:i])
+            if node is None:
+                break
+            if node._callable:
+                return node, tuple(words[i:])
+        return None, ()
+
+    def _commandPath (self, command):
+        caller, _ = self._resolve(command)
+        if caller is None:
+            return command.split(" ", 1)[0]
+        return caller._key
+
+    @property
+    def state (self):
+        """ What the session is known to be set to, by state key (see Caller). """
+        return dict(self._state)
+
+    def _stateValue (self, caller, command, args):
+        if caller._effect == "load" and len(args) > 0:
+            digest = _digestFile(args[0])
+            return command + "\n" + digest if digest is not None else None
+        return command
+
+    def _elide (self, caller, args, coder):
+        """ Completes a call locally if the session is already in the state it would set. """
+        key = caller._stateKey if caller is not None else None
+        if key is None or key not in self._state or self._st != self._IDLE_RDY:
+            return False
+        value = self._stateValue(caller, coder.command, args)
+        if value is None or self._state[key] != value:
+            return False
+        LogCubeExec.debug("(elided) " + coder.command)
+        self.elided += 1
+        tracer, traceId = self._tracing()
+        if tracer is not None:
+            tracer.instant("elided", traceId, command=coder.command)
+        coder._replay([], MxStatus.MxOK)
+        return True
+
+    def _version (self):
+        if self._mxVersion is None:
+            coder = Coder("get version")
+            self._transact(coder)
+            self._mxVersion = "\n".join(coder.data) if coder.status == MxStatus.MxOK else "unknown"
+        return self._mxVersion
+
+    def _track (self, caller, command, args, status = MxStatus.MxOK):
+        """
+        Follows a call that may have changed CubeMX state: it is journalled
+        for replay after a restart, the known session state is updated and
+        the project fingerprint moves on.
+        """
+        effect = caller._effect if caller is not None else None
+        if effect == "query" or effect == "action":
+            return
+        # Calls without a caller have an unknown effect and aren't replayed.
+        if caller is not None and status == MxStatus.MxOK:
+            if effect == "load":
+                del self._journal[:]
+            self._journal.append((caller, command, args))
+        key = caller._stateKey if caller is not None else None
+        # Anything that changes state in an untracked way leaves nothing known.
+        if effect == "load" or key is None:
+            self._state.clear()
+        if key is not None:
+            value = self._stateValue(caller, command, args) if status == MxStatus.MxOK else None
+            if value is not None:
+                self._state[key] = value
+            else:
+                self._state.pop(key, None)
+        if self._cache is None:
+            return
+        old = self._fingerprint
+        h = hashlib.sha1()
+        if effect == "load" and len(args) > 0:
+            h.update(bytes(command + "\n" + (_digestFile(args[0]) or ""), "utf-8"))
+        else:
+            h.update(bytes(old + "\n" + command, "utf-8"))
+        self._fingerprint = h.hexdigest()
+        if self._fingerprint != old:
+            self._cache.invalidate(old)
+
+    def batch (self, stopOnError = False, window = 32):
+        """
+        Collects calls made on this session and sends them pipelined when the
+        with block exits. Each call returns an MxFuture.
+
+            with session.batch() as b:
+                r = session.nvic.set_priority("EXTI0_IRQn", "5")
+            r.status
+        """
+        from .batch import MxBatch
+        return MxBatch(self, stopOnError=stopOnError, window=window)
+
+    def _ready (self):
+        """ Connects on first use and restarts the session after a crash or timeout. """
+        if self._st == self._IDLE_RDY and self._proc.poll() is not None:
+            Log.error("STM32CubeMX exited while idle.")
+            self._st = self._CONNECTION_DROPPED
+        if self._st == self._CONNECTION_DROPPED and self._autoRestart:
+            self._recover()
+        elif self._st == self._NOT_CONNECTED:
+            self.connect()
+
+    def _recover (self):
+        """ Starts a new CubeMX and replays the state-changing calls made since the last load. """
+        started = time.monotonic()
+        tracer, traceId = self._tracing()
+        traceStart = tracer.now() if tracer is not None else None
+        journal, self._journal = self._journal, []
+        Log.warning("Restarting STM32CubeMX, replaying {} call(s)...".format(len(journal)))
+        try:
+            self.disconnect()
             self.connect()
+            for i, (caller, command, args) in enumerate(journal):
+                coder = Coder(command)
+                self._transact(coder)
+                if coder.status in (MxStatus.MxTimeout, MxStatus.MxTerminated):
+                    raise MxException("Session recovery failed while replaying '" + command + "'.")
+                if coder.status != MxStatus.MxOK:
+                    Log.warning("Replayed call failed: " + command)
+                self._track(caller, command, args)
+        except:
+            # Keep what is still to be replayed for the next attempt.
+            self._journal = journal
+            raise
+        self.restarts += 1
+        self.lastRecoveryTime = time.monotonic() - started
+        self.recoveryTime += self.lastRecoveryTime
+        if self._metrics is not None:
+            self._metrics.recovered(self.lastRecoveryTime)
+        if tracer is not None:
+            tracer.complete("recover", traceStart, traceId, replayed=len(journal))
+        Log.warning("Session recovered in {:.3f}s".format(self.lastRecoveryTime))
+
+    def _kill (self, reason):
+        Log.error("{}, killing STM32CubeMX.".format(reason))
+        for line in self._stderrTail:
+            Log.error("(stderr) " + line)
+        proc, self._proc = self._proc, None
+        self._reader = None
+        self._st = self._CONNECTION_DROPPED
+        if proc is not None:
+            try:
+                proc.kill()
+                proc.wait(5)
+            except:
+                Log.exception("Unable to kill process.")
+
+    def _deadline (self, timeout):
+        if timeout is None:
+            timeout = self._commandTimeout
+        return time.monotonic() + timeout if timeout is not None else None
+
+    def _transactMany (self, transacts, window = 32, stopOnError = False, timeout = None, calls = None):
+        """
+        Pipelined _transact. Up to 'window' commands are written ahead of the
+        response being read; responses are matched to commands in order by
+        their OK/KO terminator. With stopOnError nothing more is written after
+        the first failure, although commands already in flight still complete.
+        Commands that were never sent stay MxUnprocessed. The timeout applies
+        to each response. If the (caller, args) each command was made from are
+        given in 'calls', leading calls that would not change the session
+        state are skipped and the rest are tracked.
+        """
+        self._closeStream()
+        self._ready()
+
+        if self._st != self._IDLE_RDY:
+            Log.error("Error: Bad State {}".format(self._st))
+            for i in transacts:
+                i.fail(MxStatus.MxTerminated)
+            return
+
+        if calls is not None:
+            # Past the first call that is sent the state is no longer known.
+            skip = 0
+            while skip < len(transacts) and self._elide(calls[skip][0], calls[skip][1], transacts[skip]):
+                skip += 1
+            self._pipeline(transacts[skip:], window, stopOnError, timeout)
+            for (caller, args), coder in zip(calls[skip:], transacts[skip:]):
+                if coder.status != MxStatus.MxUnprocessed:
+                    self._track(caller, coder.command, args, coder.status)
+        else:
+            self._pipeline(transacts, window, stopOnError, timeout)
+
+    def _pipeline (self, transacts, window, stopOnError, timeout):
+        metrics = self._metrics
+        sentAt = []
+        tracer, traceId = self._tracing()
+        traceStart = tracer.now() if tracer is not None else None
+        self._st = self._BSY
+        sent = 0
+        done = 0
+        stop = False
+        try:
+            while done < len(transacts):
+                while not stop and sent < len(transacts) and sent - done < window:
+                    LogCubeExec.debug("(start) " + transacts[sent].command)
+                    self._proc.stdin.write(bytes(transacts[sent].command + "\n",Encoding))
+                    if metrics is not None:
+                        sentAt.append(time.monotonic())
+                    sent += 1
+                self._proc.stdin.flush()
+                if done == sent:
+                    break
+                transact = transacts[done]
+                deadline = self._deadline(timeout)
+                first = None
+                lines = 0
+                nbytes = 0
+                recorded = [] if self._recorder is not None else None
+                recordStart = time.monotonic()
+                while transact.pending:
+                    line = self._reader.readline(deadline)
+                    if line is None:
+                        raise EOFError("STM32CubeMX closed its output.")
+                    if recorded is not None:
+                        recorded.append((time.monotonic() - recordStart, line))
+                    if metrics is not None:
+                        if first is None:
+                            first = time.monotonic()
+                        lines += 1
+                        nbytes += len(line) + 1
+                    if _feedLine(transact, line) and tracer is not None:
+                        tracer.instant("cubemx log", traceId, line=line.rstrip())
+                LogCubeExec.debug("(done) " + transact.command + " -> " + transact.status.name)
+                if metrics is not None:
+                    self._meter(transact, sentAt[done], first, lines, nbytes)
+                if recorded is not None:
+                    self._recorder.command(transact.command, recorded)
+                if stopOnError and transact.status != MxStatus.MxOK:
+                    stop = True
+                done += 1
+        except TimeoutError:
+            self.timeouts += 1
+            transacts[done].fail(MxStatus.MxTimeout)
+            for i in transacts[done+1:sent]:
+                i.fail(MxStatus.MxTerminated)
+            self._kill("Timeout: " + transacts[done].command)
+        except Exception as e:
+            if isinstance(e, (EOFError,ChildProcessError,BrokenPipeError)):
+                Log.error("Error: {}".format(str(e)))
+            else:
+                Log.exception("Exception Caught")
+            for i in transacts[done:sent]:
+                i.fail(MxStatus.MxTerminated)
+            self._kill("Batch aborted")
+        finally:
+            if self._st == self._BSY:
+                self._st = self._IDLE_RDY
+            if metrics is not None:
+                for i in range(done, sent):
+                    self._meter(transacts[i], sentAt[i], None, 0, 0)
+            if tracer is not None:
+                tracer.complete("batch", traceStart, traceId, sent=sent, done=done)
+
+    def _meter (self, transact, started, first, lines, nbytes):
+        now = time.monotonic()
+        self._metrics.command(self._commandPath(transact.command), transact.status, now - started,
+                              first - started if first is not None else None, lines, nbytes)
+
+    def _transact (self, transact, timeout = None):
+        self._closeStream()
+        for _ in self._exchange(transact, timeout):
+            pass
+
+    def _stream (self, transact, caller = None, args = (), timeout = None):
+        self._closeStream()
+        self._ready()
+        exchange = self._tracked(self._exchange(transact, timeout), transact, caller, args)
+        self._openStream = exchange
+        return MxStream(transact, exchange)
+
+    def _tracked (self, exchange, transact, caller, args):
+        # Tracks a streamed call once its status is known, i.e. after the
+        # response has been read or drained on close, as _execute does.
+        try:
+            yield from exchange
+        finally:
+            self._track(caller, transact.command, args, transact.status)
+
+    def _closeStream (self):
+        if self._openStream is not None:
+            exchange, self._openStream = self._openStream, None
+            exchange.close()
+
+    def _discardRest (self, transact, deadline):
+        try:
+            while transact.pending:
+                line = self._reader.readline(deadline)
+                if line is None:
+                    self._st = self._CONNECTION_DROPPED
+                    transact.fail(MxStatus.MxTerminated)
+                    return
+                _feedLine(transact, line)
+                del transact.data[:]
+        except TimeoutError:
+            self.timeouts += 1
+            transact.fail(MxStatus.MxTimeout)
+            self._kill("Timeout: " + transact.command)
+        except Exception as e:
+            Log.error("Error: {}".format(str(e)))
+            transact.fail(MxStatus.MxTerminated)
+            self._st = self._CONNECTION_DROPPED
+
+    def _exchange (self, transact, timeout = None):
+        # Yields whenever the lines read so far are used up, so callers can
+        # consume results in chunks as they arrive; _transact simply runs it
+        # to completion. The deadline covers the whole response.
+        Log.debug("mx exec>> " + transact.command)
+        self._ready()
 
         if self._st == self._IDLE_RDY:
             self._st = self._BSY
+            deadline = self._deadline(timeout)
+            metrics = self._metrics
+            started = time.monotonic() if metrics is not None else None
+            tracer, traceId = self._tracing()
+            traceStart = tracer.now() if tracer is not None else None
+            recorder = self._recorder
+            recorded = [] if recorder is not None else None
+            first = None
+            lines = 0
+            nbytes = 0
             try:
                 LogCubeExec.debug("(start) " + transact.command)
                 self._proc.stdin.write(bytes(transact.command + "\n",Encoding))
                 self._proc.stdin.flush()
+                recordStart = time.monotonic()
                 while transact.pending:
-                    line = self._proc.stdout.readline().decode(Encoding)
-                    if len(line) == 0:
-                        self._st = self._CONNECTION_DROPPED
+                    line = self._reader.readline(deadline)
+                    if recorded is not None and line is not None:
+                        recorded.append((time.monotonic() - recordStart, line))
+                    if line is None:
                         transact.fail(MxStatus.MxTerminated)
+                        self._kill("STM32CubeMX exited during '" + transact.command + "'")
                         return
-                    line = line.rstrip()
-                    m = self._RE_LOGITEM.match(line)
-                    if m:
-                        LogCubeLogs.debug("(log) " + line)
-                    else:
-                        LogCubeResp.debug("(recv) " + line)
-                        transact._emit(line)
+                    if metrics is not None:
+                        if first is None:
+                            first = time.monotonic()
+                        lines += 1
+                        nbytes += len(line) + 1
+                    if _feedLine(transact, line) and tracer is not None:
+                        tracer.instant("cubemx log", traceId, line=line.rstrip())
+                    if not self._reader.hasLine:
+                        yield
+            except GeneratorExit:
+                # Closed early: drain the response so the session stays in step.
+                del transact.data[:]
+                self._discardRest(transact, deadline)
+                raise
+            except TimeoutError:
+                self.timeouts += 1
+                transact.fail(MxStatus.MxTimeout)
+                self._kill("Timeout: " + transact.command)
             except (EOFError,ChildProcessError,BrokenPipeError) as e:
                 Log.error("Error: {}".format(str(e)))
                 transact.fail(MxStatus.MxTerminated)
@@ -448,7 +1230,15 @@ class MxConnection (object):
                 transact.fail(MxStatus.MxTerminated)
                 self._st = self._CONNECTION_DROPPED
             finally:
-                self._st = self._IDLE_RDY
+                if self._st == self._BSY:
+                    self._st = self._IDLE_RDY
+                if metrics is not None:
+                    self._meter(transact, started, first, lines, nbytes)
+                if tracer is not None:
+                    tracer.complete("command", traceStart, traceId,
+                                    command=transact.command, status=transact.status.name)
+                if recorder is not None:
+                    recorder.command(transact.command, recorded)
                 LogCubeExec.debug("(done) " + transact.command + " -> " + transact.status.name)
         else:
             Log.error("Error: Bad State {}".format(self._st))
@@ -480,13 +1270,7 @@ class MxConnection (object):
         Log.info ("** Detection Completed - Found {} items. **".format(count))
         """
     def _getcall (self, api):
-        base = self._ns
-        for i in api:
-            o = base._getChild(i)
-            if o is None:
-                return None
-            base = o
-        return base
+        return self._ns._lookup(api)
 
     def dump (self,wrfunc=None,**kwargs):
         if wrfunc is None:
@@ -0,0 +1,148 @@
+import os
+import logging
+import queue
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from .native import MxConnection, MxException
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("MxSessionPool", "MxPoolException")
+
+class MxPoolException(MxException): pass
+
+class MxSessionPool (object):
+    """
+    A set of warm STM32CubeMX sessions that can be leased out to run
+    independent jobs in parallel. Each session is a separate CubeMX process
+    so the work scales with the number of cores available.
+
+        with MxSessionPool(config, 4) as pool:
+            def job (session, ioc):
+                session.config.load(ioc)
+                session.generate.code(ioc + ".out")
+            pool.map(job, projects)
+
+    Extra keyword arguments are passed to each session, e.g. a shared
+    cache=MxQueryCache().
+    """
+    def __init__ (self, config, size = None, connectionClass = MxConnection, **sessionArgs):
+        self._config = config
+        self._sessionArgs = sessionArgs
+        self._size = size if size is not None else (os.cpu_count() or 1)
+        if self._size < 1:
+            raise MxPoolException("Pool size must be at least 1.")
+        self._connectionClass = connectionClass
+        self._idle = queue.Queue()
+        self._sessions = []
+        self._lock = threading.Lock()
+        self._executor = None
+        self._closed = True
+        self.replaced = 0
+
+    def __enter__ (self):
+        self.start()
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.close()
+
+    @property
+    def size (self):
+        return self._size
+
+    def start (self):
+        if not self._closed:
+            return
+        self._closed = False
+        Log.info("Starting {} session(s)...".format(self._size))
+        # CubeMX start-up is slow, bring the sessions up together.
+        try:
+            with ThreadPoolExecutor(self._size) as spawner:
+                sessions = list(spawner.map(lambda _: self._spawn(), range(self._size)))
+        except:
+            # Don't leave the sessions that did start running.
+            self.close()
+            raise
+        for i in sessions:
+            self._idle.put(i)
+        self._executor = ThreadPoolExecutor(self._size)
+        Log.info("Pool Ready!")
+
+    def close (self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        with self._lock:
+            sessions = list(self._sessions)
+            self._sessions = []
+        for i in sessions:
+            try:
+                i.disconnect()
+            except:
+                Log.exception("Error while disconnecting pooled session.")
+        while not self._idle.empty():
+            self._idle.get_nowait()
+
+    def _spawn (self):
+        session = self._connectionClass(self._config, **self._sessionArgs)
+        session.connect()
+        with self._lock:
+            self._sessions.append(session)
+        return session
+
+    def _discard (self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+        try:
+            session.disconnect()
+        except:
+            Log.exception("Error while disconnecting dead session.")
+
+    def _replace (self, session):
+        Log.info("Replacing dead session.")
+        self._discard(session)
+        self.replaced += 1
+        return self._spawn()
+
+    @contextmanager
+    def lease (self, timeout = None):
+        """Borrow a live session for the duration of the with block."""
+        if self._closed:
+            raise MxPoolException("Pool is not running.")
+        try:
+            session = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise MxPoolException("Timed out waiting for a free session.")
+        try:
+            if not session.alive:
+                session = self._replace(session)
+        except:
+            # Keep the pool at full strength even if respawning failed; the
+            # next lease of this session retries the respawn.
+            self._idle.put(session)
+            raise
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+    def _run (self, func, args, kwargs):
+        with self.lease() as session:
+            return func(session, *args, **kwargs)
+
+    def submit (self, func, *args, **kwargs):
+        """Run func(session, *args, **kwargs) on the next free session. Returns a Future."""
+        if self._closed:
+            raise MxPoolException("Pool is not running.")
+        return self._executor.submit(self._run, func, args, kwargs)
+
+    def map (self, func, *iterables, timeout = None):
+        """Like map(), but func receives a leased session as its first argument."""
+        futures = [self.submit(func, *args) for args in zip(*iterables)]
+        return [f.result(timeout) for f in futures]
@@ -0,0 +1,116 @@
+import os
+import logging
+import subprocess
+import tempfile
+import time
+from .native import (MxException, MxStatus, Encoding, LogCubeLogs, LogCubeResp,
+                     LogCubeExec, _buildNamespace, _feedLine)
+from .batch import MxFuture
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("MxScript",)
+
+class MxScript (object):
+    """
+    Records calls into a CubeMX script and runs it in a single non-interactive
+    CubeMX invocation. Calls return an MxFuture which is resolved from the
+    combined output once run() completes.
+
+        script = MxScript(config)
+        script.config.load(project)
+        script.generate.one_file_per_ip()
+        done = script.generate.code(outdir)
+        script.run()
+        done.status
+    """
+    def __init__ (self, config, decode = False):
+        self._config = config
+        self._decode = decode
+        self._futures = []
+        self._ran = False
+        self.runTime = None
+        config.configureLogger(LogCubeLogs)
+        config.configureLogger(LogCubeResp)
+        config.configureLogger(LogCubeExec)
+        config.configureLogger(Log)
+        self._ns = _buildNamespace(config, self)
+
+    def __getattr__ (self, name):
+        return self._ns.__getattr__(name)
+
+    def _invoke (self, caller, args, timeout = None, force = False):
+        # Calls don't run one by one: run(timeout=) bounds the whole script,
+        # and nothing is elided so force has no effect.
+        if self._ran:
+            raise MxException("Script has already been run.")
+        future = MxFuture(self, caller, caller.encode(args))
+        self._futures.append(future)
+        return future
+
+    @property
+    def futures (self):
+        return list(self._futures)
+
+    @property
+    def text (self):
+        return "".join(i.command + "\n" for i in self._futures) + "exit\n"
+
+    def save (self, filename):
+        with open(filename, "w") as f:
+            f.write(self.text)
+
+    def flush (self):
+        self.run()
+
+    def run (self, timeout = None):
+        if self._ran:
+            return self._futures
+        self._ran = True
+        cubemx = self._config.STM32CubeMX
+        if cubemx.valid is False:
+            raise MxException("STM32CubeMX tool not found.")
+
+        fd, scriptFile = tempfile.mkstemp(prefix="pycubemx-", suffix=".script")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write(self.text)
+            cmd = [cubemx.command] + list(cubemx.arguments) + ["-s", scriptFile]
+            Log.info("Running script> " + " ".join(cmd))
+            started = time.monotonic()
+            try:
+                proc = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE, timeout=timeout)
+                output = proc.stdout
+                status = MxStatus.MxTerminated
+            except subprocess.TimeoutExpired as e:
+                Log.error("Script timed out.")
+                output = e.stdout or b""
+                status = MxStatus.MxTimeout
+            except FileNotFoundError as e:
+                Log.error("Unable to locate STM32CubeMX executable.")
+                raise MxException("STM32CubeMX cannot be executed.")
+            self.runTime = time.monotonic() - started
+        finally:
+            os.unlink(scriptFile)
+
+        self._distribute(output.decode(Encoding, "replace").splitlines(), status)
+        Log.info("Script finished in {:.3f}s".format(self.runTime))
+        return self._futures
+
+    def _distribute (self, lines, status):
+        # Output is in command order; each OK/KO terminator closes one call.
+        pending = iter(self._futures)
+        current = next(pending, None)
+        for line in lines:
+            if current is None:
+                break
+            _feedLine(current._coder, line)
+            if current._coder.done:
+                LogCubeExec.debug("(done) " + current.command + " -> " + current.status.name)
+                current = next(pending, None)
+        # A call that started but never finished was cut short by the script dying.
+        if current is not None and len(current._coder.data) > 0:
+            current._coder.fail(status)
+        for i in self._futures:
+            i._resolve()
@@ -1,16 +1,25 @@
 import json
-import urllib
+import time
+import uuid
+import select
+import socket
+import threading
+import http.client
+import urllib.parse
 import logging
+from pycubemx.trace import newTraceId, active
 
 Log = logging.getLogger(__name__)
 
-__ALL__ = ('MxRemoteClient', 'MxRemoteException')
+__ALL__ = ('MxRemoteClient', 'MxRemoteException', 'MxRemoteBatch', 'MxRemoteFuture',
+           'MxRemoteStream')
 
 class MxRemoteException(Exception): pass
 
 class VBase(object):
+    __slots__ = ("_parent", "_top", "_name", "_config", "_path", "_apiPath")
+
     def __init__ (self, top, config, parent = None):
-        #self._path = []
         self._parent = parent
         self._top = top
         self._name = config['name']
@@ -19,67 +28,380 @@ class VBase(object):
             self._path = parent._path + [self._name]
         else:
             self._path = []
-    @property
-    def _apiPath (self):
-        return "::".join(self._path)
+        self._apiPath = "::".join(self._path)
 
 class VNamespace(VBase):
+    """ Children are built from the schema on first attribute access. """
+    __slots__ = ("_entries", "_nodes")
+
     def __init__ (self, *args, **argskw):
         super().__init__(*args, **argskw)
-        for i in self._config['children']:
-            if i['type'] == 'Namespace':
-                ns = VNamespace(self._top, i, self)
-                setattr(self, ns._name, ns)
-            elif i['type'] == 'Caller':
-                caller = VCaller(self._top, i, self)
-                #self._children[ns._name] = ns._name
-                setattr(self, caller._name, caller)
+        self._entries = {i['name'] : i for i in self._config['children']}
+        self._nodes = {}
+
+    def __getattr__ (self, name):
+        node = self._nodes.get(name)
+        if node is None:
+            entry = self._entries.get(name) if not name.startswith("__") else None
+            if entry is None:
+                raise AttributeError("Attr " + name + " does not exist.")
+            if entry['type'] == 'Namespace':
+                node = VNamespace(self._top, entry, self)
+            else:
+                node = VCaller(self._top, entry, self)
+            self._nodes[name] = node
+        return node
+
+    def __dir__ (self):
+        return list(self._entries.keys())
 
 class VCaller(VBase):
-    def __init__ (self, *args, **argskw):
-        super().__init__(*args, **argskw)
+    __slots__ = ()
+
+    def stream (self, *args):
+        """ Like calling, but returns an MxRemoteStream over the results as they arrive. """
+        return self._top.stream(self._apiPath, *args)
+
     def __call__ (self, *args):
         top = self._top
+        if top._batch is not None:
+            return top._batch._queue(self._apiPath, args)
         rc = top._apiReq(self._apiPath, args)
         if rc["status"] != 'success':
             raise MxRemoteException("Remote Exception: " + rc['exception'])
         else:
             return rc['result']
 
+class MxRemoteFuture(object):
+    """ The pending result of a call queued in an MxRemoteBatch. """
+    def __init__ (self, batch, api, args):
+        self._batch = batch
+        self.api = api
+        self.args = args
+        self._rc = None
+
+    def done (self):
+        return self._rc is not None
+
+    @property
+    def status (self):
+        """ "success", "failure" or "skipped" (not run after an earlier failure). """
+        if self._rc is None:
+            self._batch.flush()
+        return self._rc["status"]
+
+    @property
+    def ok (self):
+        return self.status == "success"
+
+    def result (self):
+        if self.status != "success":
+            raise MxRemoteException("Remote Exception: " + self._rc['exception'])
+        return self._rc['result']
+
+    def exception (self):
+        if self.status != "success":
+            return MxRemoteException("Remote Exception: " + self._rc['exception'])
+        return None
+
+class MxRemoteStream(object):
+    """
+    Iterates over a call's results while the server streams them. status is
+    "success" or "failure" once the stream is exhausted (None before); a
+    failure is raised as MxRemoteException at the end of the iteration.
+    Closing early drops the connection, which stops the call's output on
+    the server.
+    """
+    def __init__ (self, pool, conn, response):
+        self._pool = pool
+        self._conn = conn
+        self._response = response
+        self.status = None
+        self.mxstatus = None
+        self.exception = None
+
+    def _lines (self):
+        # read1 returns what has arrived, so records are seen as soon as the
+        # server sends them.
+        pending = b""
+        while True:
+            data = self._response.read1(65536)
+            if len(data) == 0:
+                break
+            lines = (pending + data).split(b"\n")
+            pending = lines.pop()
+            for i in lines:
+                yield i
+
+    def __iter__ (self):
+        if self._response is None:
+            return
+        for line in self._lines():
+            record = json.loads(line.decode('utf8'))
+            if "item" in record:
+                yield record["item"]
+                continue
+            self.status = record["status"]
+            self.mxstatus = record.get("mxstatus")
+            self.exception = record.get("exception")
+        self._finish()
+        if self.status != "success":
+            raise MxRemoteException("Remote Exception: " + str(self.exception))
+
+    def _finish (self):
+        if self._response is not None:
+            response, self._response = self._response, None
+            self._pool.release(self._conn, response)
+
+    def close (self):
+        if self._response is not None:
+            self._response = None
+            self._conn.close()
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.close()
+
+class MxRemoteBatch(object):
+    """
+    Collects the calls made on a client while the with block is active and
+    sends them in one /batch request on exit (or when a result is needed).
+    The server runs them in order on one session with nothing in between.
+    Use MxRemoteClient.batch() to create one.
+    """
+    def __init__ (self, client, stopOnError = False):
+        self._client = client
+        self._stopOnError = stopOnError
+        self._queued = []
+        self.futures = []
+
+    def __enter__ (self):
+        if self._client._batch is not None:
+            raise MxRemoteException("A batch is already active on this client.")
+        self._client._batch = self
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self._client._batch = None
+        if type is None:
+            self.flush()
+        else:
+            # Don't send half a script if the block itself failed.
+            for i in self._queued:
+                i._rc = {"status" : "skipped", "exception" : "Batch was not sent."}
+            self._queued = []
+
+    def _queue (self, api, args):
+        future = MxRemoteFuture(self, api, list(args))
+        self._queued.append(future)
+        self.futures.append(future)
+        return future
+
+    def flush (self):
+        queued, self._queued = self._queued, []
+        if len(queued) == 0:
+            return
+        rc = self._client._apiReq(None, None, uri="batch", body={
+            "calls" : [{"api" : i.api, "args" : i.args} for i in queued],
+            "stop_on_error" : self._stopOnError,
+        })
+        if rc["status"] != 'success':
+            raise MxRemoteException("Remote Exception: " + rc['exception'])
+        for future, result in zip(queued, rc["result"]):
+            future._rc = result
+
+    @property
+    def failed (self):
+        return [i for i in self.futures if i.done() and not i.ok]
+
+class _Connection(http.client.HTTPConnection):
+    def connect (self):
+        super().connect()
+        # Small requests back to back; don't wait to coalesce them.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class _ConnectionPool(object):
+    """
+    Keep-alive HTTP/1.1 connections to the server. A request takes an idle
+    connection (or opens one) and returns it once the response is read, so
+    threads sharing a client never share a connection. A request is only
+    sent again when sending it on a reused connection failed, so a command
+    the server may have received never runs twice.
+    """
+    def __init__ (self, host, port, keepAlive = True, maxIdle = 8):
+        self._host = host
+        self._port = port
+        self._keepAlive = keepAlive
+        self._maxIdle = maxIdle
+        self._idle = []
+        self._lock = threading.Lock()
+        self.opened = 0
+
+    @staticmethod
+    def _dropped (conn):
+        # An idle connection has nothing to read unless the server closed it.
+        if conn.sock is None:
+            return True
+        try:
+            return len(select.select([conn.sock], [], [], 0)[0]) > 0
+        except (OSError, ValueError):
+            return True
+
+    def _get (self):
+        with self._lock:
+            while len(self._idle) > 0:
+                conn = self._idle.pop()
+                if not self._dropped(conn):
+                    return conn, True
+                conn.close()
+            self.opened += 1
+        return _Connection(self._host, self._port), False
+
+    def _put (self, conn):
+        with self._lock:
+            if self._keepAlive and len(self._idle) < self._maxIdle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request (self, path, body, headers):
+        """ POSTs body and returns (status, response body). """
+        conn, response = self.open(path, body, headers)
+        try:
+            data = response.read()
+        except:
+            conn.close()
+            raise
+        self.release(conn, response)
+        return response.status, data
+
+    def open (self, path, body, headers):
+        """ POSTs body and returns (connection, response) with the body unread; see release(). """
+        while True:
+            conn, reused = self._get()
+            try:
+                conn.request("POST", path, body, headers)
+            except (ConnectionResetError, BrokenPipeError):
+                conn.close()
+                # The server closed a connection that sat idle before it got
+                # the whole request; try a fresh one.
+                if reused:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            try:
+                return conn, conn.getresponse()
+            except:
+                conn.close()
+                raise
+
+    def release (self, conn, response):
+        """ Returns the connection of open() once its response has been read to the end. """
+        if response.isclosed() and not response.will_close and self._keepAlive:
+            self._put(conn)
+        else:
+            conn.close()
+
+    def close (self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for i in idle:
+            i.close()
+
 class MxRemoteClient(object):
-    def __init__ (self, config):
+    def __init__ (self, config, tracer = None, session = None, keepAlive = True):
+        """
+        Calls from one client run on the same server session (so a load is
+        seen by the generate that follows). Clients passing the same session
+        name share a session; by default every client gets its own, which
+        close() gives back.
+        """
         self._config = config
+        self._tracer = tracer
+        self._session = session if session is not None else uuid.uuid4().hex
+        self._ownSession = session is None
+        self._bound = False
         self._serviceuri = self._config.server.uri
+        uri = urllib.parse.urlsplit(self._serviceuri)
+        self._base = uri.path if uri.path.endswith("/") else uri.path + "/"
+        self._connections = _ConnectionPool(uri.hostname, uri.port, keepAlive)
+        self._headers = {"Content-Type" : "application/json"}
         self._schema = {}
         self._ns = None
         self._secret = config.server.secret
+        self._batch = None
 
     def _uri (self, uri = None):
-        #postfix = "?key=" + (self._secret if self._secret is not None else "")
-        postfix = ""
         if uri is None:
-            return self._serviceuri + postfix
-        return self._serviceuri + uri + postfix
+            return self._base
+        return self._base + uri
 
-    def _simpleReq(self, uri):
-        """uri = self._uri(uri)
-        Log.debug ("REQ: " + uri)
-        return urllib.request.urlopen(uri)"""
+    def _request(self, uri, body):
+        status, data = self._connections.request(uri, json.dumps(body).encode('utf8'), self._headers)
+        if status != 200:
+            raise MxRemoteException("HTTP {} from {}".format(status, uri))
+        return data
 
+    def _simpleReq(self, uri):
         uri = self._uri(uri)
         Log.debug ("SIMPLE-REQ: {}".format(uri))
-        params = json.dumps({"secret" : self._secret}).encode('utf8')
-        req = urllib.request.Request(uri, data=params,headers={'content-type': 'application/json'})
-        return urllib.request.urlopen(req)
+        return json.loads(self._request(uri, {"secret" : self._secret}).decode('utf8'))
 
-    def _apiReq(self, api, args):
-        uri = self._uri("sessioncmd")
+    def close (self):
+        """ Releases this client's own server session and closes the idle connections to the server. """
+        if self._ownSession and self._bound:
+            self._bound = False
+            try:
+                self._call("release", {"session" : self._session})
+            except Exception as e:
+                Log.debug("Unable to release session: {}".format(str(e)))
+        self._connections.close()
+
+    def _apiReq(self, api, args, uri = "sessioncmd", body = None):
+        uri = self._uri(uri)
         Log.debug ("API-REQ: {} -> {}".format(uri, api))
-        params = json.dumps({"api" : api, "args" : args,"secret" : self._secret}).encode('utf8')
-        req = urllib.request.Request(uri, data=params,headers={'content-type': 'application/json'})
-        response = urllib.request.urlopen(req)
-        respData = response.read().decode('utf8')
-        return json.loads(respData)
+        body = dict(body) if body is not None else {"api" : api, "args" : args}
+        body["secret"] = self._secret
+        body["session"] = self._session
+        self._bound = True
+        tracer, traceId = active()
+        if tracer is None:
+            tracer = self._tracer
+        if tracer is None:
+            return self._post(uri, body)
+        if traceId is None:
+            traceId = newTraceId()
+        body["trace"] = traceId
+        # The server records its side under the same trace id and returns it.
+        with tracer.span("request", traceId, api=api) as spanArgs:
+            rc = self._post(uri, body)
+            spanArgs["status"] = rc.get("status")
+        tracer.extend(rc.pop("trace", []))
+        return rc
+
+    def _post(self, uri, body):
+        return json.loads(self._request(uri, body).decode('utf8'))
+
+    def stream (self, api, *args):
+        """
+        Runs api on the server and returns an MxRemoteStream over its results
+        as CubeMX produces them, instead of waiting for the whole list.
+
+            with client.stream("get::pinout") as pins:
+                for pin in pins:
+                    print(pin["pin"], pin["signal"])
+        """
+        body = {"api" : api, "args" : list(args), "secret" : self._secret, "session" : self._session}
+        self._bound = True
+        conn, response = self._connections.open(self._uri("sessionstream"), json.dumps(body).encode('utf8'), self._headers)
+        if response.status != 200:
+            conn.close()
+            raise MxRemoteException("HTTP {} from sessionstream".format(response.status))
+        return MxRemoteStream(self._connections, conn, response)
 
     def directAPI (self, api, *args):
         rc =  self._apiReq(api, args)
@@ -89,30 +411,84 @@ class MxRemoteClient(object):
             return rc['result']
 
     def disconnect (self):
-        with self._simpleReq("disconnect") as response:
-            rc = json.loads(response.read().decode('utf8'))
-            if rc['status'] != 'success':
-                raise MxRemoteException("Remote Exception: " + rc['exception'])
+        rc = self._simpleReq("disconnect")
+        if rc['status'] != 'success':
+            raise MxRemoteException("Remote Exception: " + rc['exception'])
+
+    def batch (self, stopOnError = False):
+        """
+        Sends the calls made in the with block as one request. Each call
+        returns an MxRemoteFuture. With stopOnError, calls after the first
+        failure are skipped.
+
+            with client.batch() as b:
+                r = client.nvic.set_priority("EXTI0_IRQn", "5")
+            r.result()
+        """
+        return MxRemoteBatch(self, stopOnError)
+
+    def _call (self, uri, body):
+        body["secret"] = self._secret
+        rc = self._post(self._uri(uri), body)
+        if rc['status'] != 'success':
+            raise MxRemoteException("Remote Exception: " + rc['exception'])
+        return rc['result']
+
+    def submit (self, steps, session = None):
+        """
+        Queues a job on the server and returns its id. steps are
+        (api, *args) tuples, e.g. ("config::load", "/abs/a.ioc"), run in
+        order on one session: this client's, unless another session name
+        is given. Jobs with different session names can run at once.
+        """
+        steps = [{"api" : i[0], "args" : list(i[1:])} for i in steps]
+        if session is None:
+            session = self._session
+            self._bound = True
+        return self._call("jobsubmit", {"steps" : steps, "session" : session})
+
+    def status (self, jobId, wait = 0, seen = None):
+        """ The job's state and the results of the steps run so far. """
+        return self._call("jobstatus", {"id" : jobId, "wait" : wait, "seen" : seen})
+
+    def wait (self, jobId, timeout = None, poll = 25.0):
+        """
+        Long-polls until the job has finished and returns its record. Each
+        poll is a short request, so no connection is held for the whole job.
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            wait = poll if deadline is None else max(0.0, min(poll, deadline - time.monotonic()))
+            job = self.status(jobId, wait)
+            if job["state"] in ("done", "failed", "cancelled"):
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                raise MxRemoteException("Timed out waiting for job " + jobId)
+
+    def cancel (self, jobId):
+        return self._call("jobcancel", {"id" : jobId})
+
+    def stats (self):
+        """ The server's session and queue statistics. """
+        rc = self._simpleReq("stats")
+        if rc['status'] != 'success':
+            raise MxRemoteException("Remote Exception: " + rc['exception'])
+        return rc['result']
 
     def shutdown (self):
-        with self._simpleReq("shutdown") as response:
-            rc = json.loads(response.read().decode('utf8'))
-            if rc['status'] != 'success':
-                raise MxRemoteException("Remote Exception: " + rc['exception'])
+        rc = self._simpleReq("shutdown")
+        if rc['status'] != 'success':
+            raise MxRemoteException("Remote Exception: " + rc['exception'])
 
     def init (self):
-        with self._simpleReq("schema") as response:
-            rc = json.loads(response.read().decode('utf8'))
-            if rc['status'] != 'success':
-                raise MxRemoteException("Remote Exception: " + rc['exception'])
-            self._schema = rc['result']
-            self._ns = VNamespace(self,self._schema)
-            #Log.info(str(self._schema))
+        rc = self._simpleReq("schema")
+        if rc['status'] != 'success':
+            raise MxRemoteException("Remote Exception: " + rc['exception'])
+        self._schema = rc['result']
+        self._ns = VNamespace(self,self._schema)
 
     def usage (self):
-        with self._simpleReq(None) as response:
-            result = response.read().decode('utf8')
-            return result
+        return self._request(self._uri(None), {"secret" : self._secret}).decode('utf8')
 
     def __getattr__(self, name):
         return getattr(self._ns, name)
@@ -0,0 +1,259 @@
+import time
+import logging
+import threading
+import collections
+from contextlib import contextmanager
+from pycubemx.native import MxConnection, MxException
+from pycubemx.metrics import Histogram
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ('MxSessionDispatcher', 'MxDispatchException')
+
+class MxDispatchException(MxException): pass
+
+class _Waiter (object):
+    __slots__ = ("key", "index", "session")
+
+    def __init__ (self, key, index = None):
+        self.key = key
+        self.index = index
+        self.session = None
+
+class MxSessionDispatcher (object):
+    """
+    Hands the server's CubeMX sessions out to request threads, one request
+    per session at a time. Waiting requests are served first come, first
+    served; a request only gets ahead of an earlier one when that one is
+    waiting for a different, busy session.
+
+    Requests with the same affinity key always run on the same session, so a
+    client's load/set/generate sequence sees its own project. The first
+    request of a key is bound to the free session with the fewest keys.
+    Requests without a key prefer sessions no key is bound to, and otherwise
+    take a free session none of whose keys has a request waiting or running,
+    so they neither starve nor cut into a client's sequence of calls. A key
+    is forgotten when released, or after KeyIdle seconds without requests.
+    After close() waiting and new requests fail.
+    """
+    MaxKeys = 4096
+    KeyIdle = 600.0
+
+    def __init__ (self, config, size = 1, connectionClass = MxConnection, **sessionArgs):
+        if size < 1:
+            raise MxDispatchException("Need at least one session.")
+        # Sessions connect on their first command.
+        self.sessions = [connectionClass(config, **sessionArgs) for _ in range(size)]
+        self._cond = threading.Condition()
+        self._busy = [False] * size
+        self._served = [0] * size
+        self._keys = [0] * size
+        # Bound keys in least recently used order, when they were last used
+        # and how many of their requests are waiting or running.
+        self._affinity = collections.OrderedDict()
+        self._used = {}
+        self._active = collections.Counter()
+        self._expiresAt = None
+        self._waiting = collections.deque()
+        self._closed = False
+        self.maxQueued = 0
+        self.evicted = 0
+        self.wait = Histogram()
+
+    @property
+    def size (self):
+        return len(self.sessions)
+
+    def _candidate (self, waiter, free):
+        if waiter.index is not None:
+            return waiter.index if waiter.index in free else None
+        if waiter.key is None:
+            unbound = [i for i in free if self._keys[i] == 0]
+            if len(unbound) > 0:
+                return unbound[0]
+            # Only keys with requests waiting or running are in _active.
+            claimed = set(self._affinity[k] for k in self._active if k in self._affinity)
+            idle = [i for i in free if i not in claimed]
+            return min(idle, key=lambda i: (self._keys[i], i)) if len(idle) > 0 else None
+        index = self._affinity.get(waiter.key)
+        if index is not None:
+            return index if index in free else None
+        if len(free) == 0:
+            return None
+        return min(free, key=lambda i: (self._keys[i], i))
+
+    def _forget (self, key):
+        index = self._affinity.pop(key)
+        del self._used[key]
+        self._keys[index] -= 1
+
+    def _touch (self, key):
+        self._affinity.move_to_end(key)
+        self._used[key] = time.monotonic()
+
+    def _bind (self, key, index):
+        """ Binds a new key to a session, making room for it if needed. Called locked. """
+        if len(self._affinity) >= self.MaxKeys:
+            # Only idle keys are dropped; with none, the cap is exceeded until
+            # some become idle.
+            for old in [k for k in self._affinity if self._active[k] == 0]:
+                if len(self._affinity) < self.MaxKeys:
+                    break
+                Log.warning("Too many session keys, forgetting the least recently used: {}".format(old))
+                self._forget(old)
+                self.evicted += 1
+            if len(self._affinity) >= self.MaxKeys:
+                Log.warning("Too many session keys, none idle: binding {} above the limit.".format(key))
+        self._affinity[key] = index
+        self._used[key] = time.monotonic()
+        self._keys[index] += 1
+
+    def _expire (self):
+        """ Forgets keys idle for KeyIdle seconds and notes when the next one will be. Called locked. """
+        now = time.monotonic()
+        self._expiresAt = None
+        expired = []
+        for key in self._affinity:
+            if self._active[key] > 0:
+                continue
+            expiresAt = self._used[key] + self.KeyIdle
+            if expiresAt > now:
+                # Keys are in order of last use, so this is the next to expire.
+                self._expiresAt = expiresAt
+                break
+            expired.append(key)
+        for key in expired:
+            Log.debug("Session key expired: {}".format(key))
+            self._forget(key)
+
+    def _grant (self):
+        """ Assigns free sessions to waiters in arrival order. Called locked. """
+        self._expire()
+        free = [i for i, busy in enumerate(self._busy) if not busy]
+        if len(free) == 0:
+            return
+        granted = []
+        for waiter in self._waiting:
+            index = self._candidate(waiter, free)
+            if index is None:
+                continue
+            free.remove(index)
+            waiter.session = index
+            self._busy[index] = True
+            # Bind now, so later waiters with the same key wait for this session.
+            if waiter.key is not None:
+                if waiter.key in self._affinity:
+                    self._touch(waiter.key)
+                else:
+                    self._bind(waiter.key, index)
+            granted.append(waiter)
+            if len(free) == 0:
+                break
+        if len(granted) > 0:
+            for waiter in granted:
+                self._waiting.remove(waiter)
+            self._cond.notify_all()
+
+    def _done (self, key):
+        if key is not None:
+            self._active[key] -= 1
+            if self._active[key] == 0:
+                del self._active[key]
+            if key in self._affinity:
+                self._touch(key)
+
+    @contextmanager
+    def lease (self, key = None, timeout = None):
+        """ Waits for the session of key (or any idle session) and holds it for the with block. """
+        started = time.monotonic()
+        waiter = _Waiter(key)
+        with self._cond:
+            if self._closed:
+                raise MxDispatchException("The session dispatcher is closed.")
+            if key is not None:
+                self._active[key] += 1
+            self._waiting.append(waiter)
+            self.maxQueued = max(self.maxQueued, len(self._waiting))
+            self._grant()
+            deadline = started + timeout if timeout is not None else None
+            while waiter.session is None:
+                now = time.monotonic()
+                remaining = deadline - now if deadline is not None else None
+                if self._closed or (remaining is not None and remaining <= 0):
+                    self._waiting.remove(waiter)
+                    self._done(key)
+                    if self._closed:
+                        raise MxDispatchException("The session dispatcher is closed.")
+                    raise MxDispatchException("Timed out waiting for a free session.")
+                # Also wake up when a key expires, which may free a session
+                # for requests without a key.
+                if self._expiresAt is not None:
+                    untilExpiry = max(0.0, self._expiresAt - now)
+                    remaining = untilExpiry if remaining is None else min(remaining, untilExpiry)
+                if not self._cond.wait(remaining):
+                    self._grant()
+            self.wait.observe(time.monotonic() - started)
+        index = waiter.session
+        try:
+            yield self.sessions[index]
+        finally:
+            with self._cond:
+                self._busy[index] = False
+                self._served[index] += 1
+                self._done(key)
+                self._grant()
+
+    def release (self, key):
+        """ Forgets key's session binding, unless it has requests waiting or running. """
+        with self._cond:
+            if key not in self._affinity or self._active[key] > 0:
+                return False
+            self._forget(key)
+            self._grant()
+            return True
+
+    def close (self):
+        """ Fails the requests waiting for a session, and any new ones. Leases already held run on. """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    @contextmanager
+    def exclusive (self):
+        """ Holds every session, e.g. to disconnect them all. """
+        with self._cond:
+            waiters = [_Waiter(None, i) for i in range(self.size)]
+            self._waiting.extend(waiters)
+            self._grant()
+            while any(i.session is None for i in waiters):
+                self._cond.wait()
+        try:
+            yield self.sessions
+        finally:
+            with self._cond:
+                for i in waiters:
+                    self._busy[i.session] = False
+                self._grant()
+
+    def disconnect (self):
+        with self.exclusive() as sessions:
+            for i in sessions:
+                i.disconnect()
+
+    def stats (self):
+        with self._cond:
+            return {
+                "size" : self.size,
+                "busy" : sum(self._busy),
+                "queued" : len(self._waiting),
+                "max_queued" : self.maxQueued,
+                "affinity_keys" : len(self._affinity),
+                "evicted_keys" : self.evicted,
+                "wait" : self.wait.snapshot(),
+                "sessions" : [{
+                    "busy" : self._busy[i],
+                    "served" : self._served[i],
+                    "keys" : self._keys[i],
+                    "alive" : self.sessions[i].alive,
+                } for i in range(self.size)],
+            }
@@ -0,0 +1,189 @@
+import time
+import uuid
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from pycubemx.native import MxException
+from pycubemx.decoders import toJson
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ('MxJobManager', 'MxJobException')
+
+class MxJobException(MxException): pass
+
+class _Job (object):
+    """ A sequence of API calls run back to back on one session. """
+    def __init__ (self, steps, session):
+        self.id = uuid.uuid4().hex
+        self.steps = steps
+        self.session = session
+        self.state = "queued"
+        self.results = []
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancelled = False
+        self.future = None
+
+    @property
+    def done (self):
+        return self.state in ("done", "failed", "cancelled")
+
+    def record (self):
+        return {
+            "id" : self.id,
+            "state" : self.state,
+            "steps" : len(self.steps),
+            "results" : list(self.results),
+            "error" : self.error,
+            "created" : self.created,
+            "started" : self.started,
+            "finished" : self.finished,
+        }
+
+class MxJobManager (object):
+    """
+    Runs submitted jobs on the server's sessions in the background so a
+    client can poll for them instead of holding a request open for the
+    length of a code generation.
+
+    A job's steps run in order within one session lease, so a load is seen
+    by the generate after it. The first failing step ends the job. Cancelling
+    a queued job drops it; a running job stops before its next step (the
+    command in progress is left to finish). Finished jobs are forgotten
+    after retention seconds.
+    """
+    MaxWait = 30.0
+
+    def __init__ (self, dispatcher, workers = None, retention = 3600.0):
+        self._dispatcher = dispatcher
+        self._executor = ThreadPoolExecutor(workers if workers is not None else dispatcher.size)
+        self._retention = retention
+        self._jobs = collections.OrderedDict()
+        self._cond = threading.Condition()
+
+    def _check (self, steps):
+        session = self._dispatcher.sessions[0]
+        checked = []
+        for i in steps:
+            api = i["api"] if isinstance(i, dict) else i[0]
+            args = list(i.get("args", [])) if isinstance(i, dict) else list(i[1:])
+            caller = session._getcall(api)
+            if caller is None or not caller._callable:
+                raise MxJobException("API not defined: " + str(api))
+            checked.append((api, args))
+        if len(checked) == 0:
+            raise MxJobException("A job needs at least one step.")
+        return checked
+
+    def _prune (self):
+        horizon = time.time() - self._retention
+        for jobId in [k for k, v in self._jobs.items() if v.done and v.finished < horizon]:
+            del self._jobs[jobId]
+
+    def submit (self, steps, session = None):
+        """ Queues steps, each {"api" : "a::b", "args" : [...]}, and returns the job id. """
+        job = _Job(self._check(steps), session)
+        with self._cond:
+            self._prune()
+            self._jobs[job.id] = job
+        job.future = self._executor.submit(self._run, job)
+        return job.id
+
+    def _update (self, job, **kwargs):
+        with self._cond:
+            for k, v in kwargs.items():
+                setattr(job, k, v)
+            self._cond.notify_all()
+
+    def _run (self, job):
+        if job.cancelled:
+            self._update(job, state="cancelled", finished=time.time())
+            return
+        try:
+            with self._dispatcher.lease(job.session) as session:
+                self._update(job, state="running", started=time.time())
+                for api, args in job.steps:
+                    if job.cancelled:
+                        self._update(job, state="cancelled", finished=time.time())
+                        return
+                    result = self._step(session, api, args)
+                    with self._cond:
+                        job.results.append(result)
+                        self._cond.notify_all()
+                    if result["status"] != "success":
+                        self._update(job, state="failed", error=result["exception"], finished=time.time())
+                        return
+                self._update(job, state="done", finished=time.time())
+        except Exception as e:
+            if job.cancelled:
+                self._update(job, state="cancelled", finished=time.time())
+                return
+            Log.exception("Job {} failed.".format(job.id))
+            self._update(job, state="failed", error=str(e), finished=time.time())
+
+    def _step (self, session, api, args):
+        # A KO answer doesn't raise, so the status is checked as /batch does.
+        with session.batch(window=1):
+            future = session._getcall(api)(*args)
+        try:
+            result = toJson(future.result())
+        except Exception as e:
+            return {"api" : api, "status" : "failure", "mxstatus" : future.status.name, "exception" : str(e)}
+        if not future.ok:
+            return {"api" : api, "status" : "failure", "mxstatus" : future.status.name, "result" : result,
+                    "exception" : "Command '" + future.command + "' failed."}
+        return {"api" : api, "status" : "success", "result" : result}
+
+    def _get (self, jobId):
+        job = self._jobs.get(jobId)
+        if job is None:
+            raise MxJobException("Unknown job: " + str(jobId))
+        return job
+
+    def status (self, jobId, wait = 0.0, seen = None):
+        """
+        The job's record. With wait, blocks up to that many seconds (at most
+        MaxWait) for the job to finish, or for it to have more than seen
+        results.
+        """
+        deadline = time.monotonic() + min(float(wait or 0), self.MaxWait)
+        with self._cond:
+            job = self._get(jobId)
+            while not job.done and (seen is None or len(job.results) <= seen):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return job.record()
+
+    def cancel (self, jobId):
+        with self._cond:
+            job = self._get(jobId)
+            if job.done:
+                return job.record()
+            job.cancelled = True
+            if job.state == "queued" and job.future is not None and job.future.cancel():
+                job.state = "cancelled"
+                job.finished = time.time()
+            self._cond.notify_all()
+            return job.record()
+
+    def list (self):
+        with self._cond:
+            return [{"id" : k, "state" : v.state} for k, v in self._jobs.items()]
+
+    def close (self):
+        """
+        Cancels every job and closes the dispatcher, so workers waiting for
+        a session give up instead of keeping the interpreter from exiting.
+        """
+        with self._cond:
+            jobs = list(self._jobs.keys())
+        for i in jobs:
+            self.cancel(i)
+        self._dispatcher.close()
+        self._executor.shutdown(wait=False)
@@ -1,7 +1,12 @@
 import cherrypy
+import json
 import logging
 from pycubemx.config import Config
-from pycubemx.native import MxConnection
+from pycubemx.native import MxStatus
+from pycubemx.decoders import toJson
+from pycubemx.trace import MxTracer, activate
+from pycubemx.server.dispatch import MxSessionDispatcher
+from pycubemx.server.jobs import MxJobManager
 import io
 
 Log = logging.getLogger(__name__)
@@ -14,19 +19,24 @@ cherrypy.config.update({
 
 class NotAuthorized (object): pass
 
+def _ndjson(record):
+    return (json.dumps(record) + "\n").encode("utf8")
+
 class CubeMXApi(object):
     def __init__ (self, config):
         self._config = config
         self._secret = config.server.secret
         Log.info("Command DB Version: " + str(self._config.commandDbVersionInfo))
-        self._session = MxConnection(self._config)
+        # CherryPy handles requests on a thread pool; each session takes one at a time.
+        self._sessions = MxSessionDispatcher(self._config, config.server.sessions, decode=config.server.decode)
+        self._jobs = MxJobManager(self._sessions)
 
     @cherrypy.expose
     def index(self):
         cherrypy.response.headers['Content-Type']='text/plain; charset=utf-8'
-        s = io.StringIO()
-        self._session.dump(lambda x: s.write(x + "\n"), includeHelp=True)
-        return s.getvalue()
+        lines = self._sessions.sessions[0]._ns._lines(includeHelp=True)
+        return ((i + "\n").encode("utf8") for i in lines)
+    index._cp_config = {"response.stream" : True}
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -54,18 +64,75 @@ class CubeMXApi(object):
     def disconnect(self):
         try:
             self.check()
-            req = cherrypy.request.json
-            self._session.disconnect()
+            self._sessions.disconnect()
             return {"status": "success"}
         except Exception as e:
             return {"status": "failure", "exception" : str(e)}
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def stats(self):
+        try:
+            self.check()
+            return {"status": "success", "result" : self._sessions.stats()}
+        except Exception as e:
+            return {"status": "failure", "exception" : str(e)}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def release(self):
+        """ Forgets a client's session binding so its session can serve others. """
+        try:
+            self.check()
+            return {"status": "success", "result" : self._sessions.release(cherrypy.request.json.get("session"))}
+        except Exception as e:
+            return {"status": "failure", "exception" : str(e)}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def jobsubmit(self):
+        try:
+            self.check()
+            req = cherrypy.request.json
+            jobId = self._jobs.submit(req.get("steps", []), req.get("session"))
+            return {"status": "success", "result" : jobId}
+        except Exception as e:
+            return {"status": "failure", "exception" : str(e)}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def jobstatus(self):
+        try:
+            self.check()
+            req = cherrypy.request.json
+            if "id" not in req:
+                return {"status": "success", "result" : self._jobs.list()}
+            return {"status": "success", "result" : self._jobs.status(req["id"], req.get("wait", 0), req.get("seen"))}
+        except Exception as e:
+            return {"status": "failure", "exception" : str(e)}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def jobcancel(self):
+        try:
+            self.check()
+            req = cherrypy.request.json
+            return {"status": "success", "result" : self._jobs.cancel(req["id"])}
+        except Exception as e:
+            return {"status": "failure", "exception" : str(e)}
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
     @cherrypy.tools.json_in()
     def shutdown(self):
         try:
             self.check()
+            self._jobs.close()
             cherrypy.engine.exit()
             return {"status": "success"}
         except Exception as e:
@@ -76,27 +143,129 @@ class CubeMXApi(object):
     def sessioncmd(self):
         try:
             self.check()
-            req = cherrypy.request.json
-            #value = input_json["my_key"]
-            if "api" in req:
-                api = req ["api"].split("::")
-                args = [] if "args" not in req else req["args"]
-                obj = self._session._getcall(api)
-                if obj is None:
-                    return {"status":"failure", "exception":"API not defined."}
-                elif obj._callable:
-                    result = obj(*args)
-                    return {"status": "success", "is_ns_call" : False, "result" : result}
-                else:
-                    s = io.StringIO()
-                    obj._dump(lambda x: s.write(x + "\n"), includeHelp=True)
-                    return {"status": "success", "is_ns_call" : True, "result" : s.getvalue().split("\n")}
-            return {"status": "failure", "exception" : "Unhandled Path"}
+            return self._traced("sessioncmd", self._sessioncmd)
         except Exception as e:
             return {"status": "failure", "exception" : str(e)}
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    @cherrypy.tools.json_in()
+    def batch(self):
+        try:
+            self.check()
+            return self._traced("batch", self._batch)
+        except Exception as e:
+            return {"status": "failure", "exception" : str(e)}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    def sessionstream(self):
+        """
+        Runs one call and streams its results as newline delimited JSON while
+        CubeMX produces them: {"item" : ...} per result, then a last record
+        with the status.
+        """
+        cherrypy.response.headers['Content-Type'] = 'application/x-ndjson'
+        try:
+            self.check()
+            req = cherrypy.request.json
+            obj = self._sessions.sessions[0]._getcall(req.get("api"))
+            if obj is None or not obj._callable:
+                raise Exception("API not defined.")
+        except Exception as e:
+            return iter([_ndjson({"status": "failure", "exception" : str(e)})])
+        return self._stream(req["api"], req.get("args", []), req.get("session"))
+    sessionstream._cp_config["response.stream"] = True
+
+    def _stream(self, api, args, key):
+        # Runs as CherryPy writes the response; the lease and the stream are
+        # released when the generator finishes or the client goes away.
+        try:
+            with self._sessions.lease(key) as session:
+                with session._getcall(api).stream(*args) as stream:
+                    for items in stream.chunks():
+                        yield b"".join(_ndjson({"item" : i}) for i in toJson(items))
+                    status = stream.status
+            if status == MxStatus.MxOK:
+                yield _ndjson({"status": "success", "mxstatus" : status.name})
+            else:
+                yield _ndjson({"status": "failure", "mxstatus" : status.name,
+                               "exception" : "Command failed ({}).".format(status.name)})
+        except GeneratorExit:
+            raise
+        except Exception as e:
+            yield _ndjson({"status": "failure", "exception" : str(e)})
+
+    def _traced(self, name, handler):
+        req = cherrypy.request.json
+        # A request carrying a trace id gets its server side spans back.
+        traceId = req.get("trace")
+        if traceId is None:
+            return handler(req)
+        tracer = MxTracer("pycubemx.server")
+        with activate(tracer, traceId):
+            with tracer.span(name, traceId, api=req.get("api")):
+                rc = handler(req, tracer, traceId)
+        rc["trace"] = tracer.events
+        return rc
+
+    def _batch(self, req, tracer = None, traceId = None):
+        calls = []
+        for i in req.get("calls", []):
+            obj = self._sessions.sessions[0]._getcall(i["api"])
+            if obj is None or not obj._callable:
+                return {"status":"failure", "exception":"API not defined: " + str(i["api"])}
+            calls.append((i["api"], i.get("args", [])))
+        waitStart = tracer.now() if tracer is not None else None
+        # One lease for the whole list, so no other request runs in between.
+        with self._sessions.lease(req.get("session")) as session:
+            if tracer is not None:
+                tracer.complete("session wait", waitStart, traceId)
+            # Pipelined calls already sent would still run after a failure,
+            # so stopping on error sends one at a time.
+            stopOnError = bool(req.get("stop_on_error", False))
+            with session.batch(stopOnError=stopOnError, window=1 if stopOnError else 32):
+                futures = [session._getcall(api)(*args) for api, args in calls]
+        results = []
+        for i in futures:
+            try:
+                result = toJson(i.result())
+            except Exception as e:
+                state = "skipped" if i.status == MxStatus.MxUnprocessed else "failure"
+                results.append({"status" : state, "mxstatus" : i.status.name, "exception" : str(e)})
+                continue
+            if i.ok:
+                results.append({"status" : "success", "result" : result})
+            else:
+                # CubeMX answered KO; its output usually says why.
+                results.append({"status" : "failure", "mxstatus" : i.status.name, "result" : result,
+                                "exception" : "Command '" + i.command + "' failed."})
+        return {"status": "success", "result" : results}
 
+    def _sessioncmd(self, req, tracer = None, traceId = None):
+        #value = input_json["my_key"]
+        if "api" in req:
+            args = [] if "args" not in req else req["args"]
+            # Namespaces and unknown paths are answered from the schema alone.
+            obj = self._sessions.sessions[0]._getcall(req["api"])
+            if obj is None:
+                return {"status":"failure", "exception":"API not defined."}
+            elif obj._callable:
+                waitStart = tracer.now() if tracer is not None else None
+                with self._sessions.lease(req.get("session")) as session:
+                    if tracer is not None:
+                        tracer.complete("session wait", waitStart, traceId)
+                    result = toJson(session._getcall(req["api"])(*args))
+                return {"status": "success", "is_ns_call" : False, "result" : result}
+            else:
+                s = io.StringIO()
+                obj._dump(lambda x: s.write(x + "\n"), includeHelp=True)
+                return {"status": "success", "is_ns_call" : True, "result" : s.getvalue().split("\n")}
+        return {"status": "failure", "exception" : "Unhandled Path"}
 
 def runServer (config):
     cherrypy.config.update(config.server._config)
+    # Leave request threads free while every session is busy.
+    if "server.thread_pool" not in config.server._config:
+        cherrypy.config.update({"server.thread_pool" : max(10, 2 * config.server.sessions)})
     cherrypy.quickstart(CubeMXApi(config))
@@ -0,0 +1,85 @@
+import os
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("GenerateStamp",)
+
+def _depEscape (path):
+    return str(path).replace("$", "$$").replace("#", "\\#").replace(" ", "\\ ")
+
+class GenerateStamp (object):
+    """
+    Records what a code generation run was made from so the next run can be
+    skipped when nothing changed. The stamp holds a fingerprint of the .ioc
+    contents, the CubeMX command line and the generation options, plus the
+    list of generated files. An optional Make/Ninja style depfile names the
+    stamp and the generated files as depending on the .ioc.
+    """
+    def __init__ (self, stampFile, depFile = None):
+        self.stampFile = Path(stampFile)
+        self.depFile = Path(depFile) if depFile is not None else None
+
+    @staticmethod
+    def fingerprint (project, tool, **options):
+        h = hashlib.sha256()
+        with open(str(project), "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+        h.update(json.dumps({
+            "command" : tool.command,
+            "arguments" : list(tool.arguments),
+            "options" : options,
+        }, sort_keys=True).encode("utf-8"))
+        return h.hexdigest()
+
+    def _read (self):
+        try:
+            with open(str(self.stampFile), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def upToDate (self, fingerprint):
+        stamp = self._read()
+        if stamp is None or stamp.get("fingerprint") != fingerprint:
+            return False
+        for i in stamp.get("outputs", []):
+            if not os.path.exists(i):
+                Log.info("Missing output: " + i)
+                return False
+        if self.depFile is not None and not self.depFile.exists():
+            return False
+        return True
+
+    @staticmethod
+    def scan (outdir, exclude = ()):
+        exclude = set(os.path.abspath(str(i)) for i in exclude if i is not None)
+        outputs = []
+        for root, dirs, files in os.walk(str(outdir)):
+            dirs.sort()
+            for name in sorted(files):
+                path = os.path.abspath(os.path.join(root, name))
+                if path not in exclude:
+                    outputs.append(path)
+        return outputs
+
+    def write (self, fingerprint, project, outputs):
+        os.makedirs(str(self.stampFile.parent), exist_ok=True)
+        tmp = str(self.stampFile) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "fingerprint" : fingerprint,
+                "project" : str(project),
+                "outputs" : list(outputs),
+            }, f, indent=2)
+        os.replace(tmp, str(self.stampFile))
+        if self.depFile is not None:
+            os.makedirs(str(self.depFile.parent), exist_ok=True)
+            targets = [self.stampFile] + list(outputs)
+            with open(str(self.depFile), "w") as f:
+                f.write(" \\\n  ".join(_depEscape(i) for i in targets))
+                f.write(": \\\n  " + _depEscape(project) + "\n")
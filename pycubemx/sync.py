@@ -0,0 +1,146 @@
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("StagedOutput", "SyncSummary", "syncTree")
+
+# mtime given to seeded files so we can tell which ones CubeMX did not rewrite.
+_SEED_MTIME = 1
+
+def _digest (path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            h.update(chunk)
+    return h.digest()
+
+def _same (a, b):
+    try:
+        if os.path.getsize(a) != os.path.getsize(b):
+            return False
+    except OSError:
+        return False
+    return _digest(a) == _digest(b)
+
+def _walk (top):
+    for root, dirs, files in os.walk(top):
+        dirs.sort()
+        for name in sorted(files):
+            yield os.path.relpath(os.path.join(root, name), top)
+
+class SyncSummary (object):
+    def __init__ (self):
+        self.added = []
+        self.updated = []
+        self.unchanged = []
+        self.removed = []
+        self.kept = []
+
+    @property
+    def changed (self):
+        return len(self.added) + len(self.updated) + len(self.removed) > 0
+
+    @property
+    def outputs (self):
+        return sorted(self.added + self.updated + self.unchanged)
+
+    def __str__ (self):
+        return "added {}, updated {}, unchanged {}, removed {}, kept {}".format(
+            len(self.added), len(self.updated), len(self.unchanged), len(self.removed), len(self.kept))
+
+def syncTree (staging, outdir, removeStale = False, exclude = (), untouched = ()):
+    """
+    Copies files from staging into outdir, writing only those whose content
+    differs so unchanged files keep their mtime. Files listed in 'untouched'
+    (relative paths) are seeded copies CubeMX did not write; like any other
+    file in outdir that was not regenerated they are kept, or deleted with
+    removeStale. Paths in the summary are relative to outdir.
+    """
+    summary = SyncSummary()
+    exclude = set(os.path.normpath(i) for i in exclude)
+    untouched = set(untouched)
+    generated = set()
+    for rel in _walk(staging):
+        if rel in exclude:
+            continue
+        if rel in untouched:
+            continue
+        generated.add(rel)
+        src = os.path.join(staging, rel)
+        dst = os.path.join(outdir, rel)
+        if os.path.exists(dst):
+            if _same(src, dst):
+                summary.unchanged.append(rel)
+                continue
+            summary.updated.append(rel)
+        else:
+            summary.added.append(rel)
+        os.makedirs(os.path.dirname(dst) or ".", exist_ok=True)
+        tmp = dst + ".pycubemx-tmp"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+
+    if os.path.isdir(outdir):
+        for rel in list(_walk(outdir)):
+            if rel in generated or rel in exclude:
+                continue
+            if removeStale:
+                os.unlink(os.path.join(outdir, rel))
+                summary.removed.append(rel)
+            else:
+                summary.kept.append(rel)
+        if removeStale:
+            for root, dirs, files in os.walk(outdir, topdown=False):
+                if root != outdir and len(os.listdir(root)) == 0:
+                    os.rmdir(root)
+    return summary
+
+class StagedOutput (object):
+    """
+    A staging directory for generate::code. It is seeded with the current
+    contents of outdir (so CubeMX keeps the USER CODE sections) and synced
+    back with syncTree() when the with block exits without an exception.
+
+        with StagedOutput(outdir) as staging:
+            session.generate.code(staging.path)
+        print(staging.summary)
+    """
+    def __init__ (self, outdir, removeStale = False, exclude = ()):
+        self.outdir = str(Path(outdir).resolve())
+        self.removeStale = removeStale
+        self.exclude = [os.path.relpath(str(Path(i).resolve()), self.outdir) for i in exclude if i is not None]
+        self.path = None
+        self.summary = None
+
+    def __enter__ (self):
+        parent = os.path.dirname(self.outdir)
+        os.makedirs(parent, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=".pycubemx-stage-", dir=parent)
+        if os.path.isdir(self.outdir):
+            for rel in _walk(self.outdir):
+                dst = os.path.join(self.path, rel)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copyfile(os.path.join(self.outdir, rel), dst)
+                os.utime(dst, (_SEED_MTIME, _SEED_MTIME))
+        return self
+
+    def _untouched (self):
+        result = []
+        for rel in _walk(self.path):
+            if os.stat(os.path.join(self.path, rel)).st_mtime == _SEED_MTIME:
+                result.append(rel)
+        return result
+
+    def __exit__ (self, type, value, traceback):
+        try:
+            if type is None:
+                self.summary = syncTree(self.path, self.outdir, self.removeStale,
+                                        self.exclude, self._untouched())
+                Log.info("Synced {}: {}".format(self.outdir, self.summary))
+        finally:
+            shutil.rmtree(self.path, ignore_errors=True)
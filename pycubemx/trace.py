@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("MxTracer", "newTraceId", "activate", "active")
+
+_local = threading.local()
+
+def newTraceId ():
+    return uuid.uuid4().hex[:16]
+
+def active ():
+    """ The (tracer, traceId) activated on this thread, or (None, None). """
+    return getattr(_local, "tracer", None), getattr(_local, "traceId", None)
+
+@contextmanager
+def activate (tracer, traceId = None):
+    """ Routes spans recorded on this thread to tracer, tagged with traceId. """
+    previous = active()
+    _local.tracer = tracer
+    _local.traceId = traceId if traceId is not None else newTraceId()
+    try:
+        yield _local.traceId
+    finally:
+        _local.tracer, _local.traceId = previous
+
+class MxTracer (object):
+    """
+    Collects spans and instant events in the Chrome trace event format, which
+    Perfetto and chrome://tracing can open. Timestamps are wall clock
+    microseconds so traces recorded by a client and a server on the same
+    machine line up when their events are combined.
+
+        tracer = MxTracer()
+        with MxConnection(config, tracer=tracer) as session:
+            session.generate.code(outdir)
+        tracer.save("trace.json")
+    """
+    def __init__ (self, processName = None):
+        self._lock = threading.Lock()
+        self.pid = os.getpid()
+        self.events = [{
+            "name" : "process_name", "ph" : "M", "pid" : self.pid, "tid" : 0,
+            "args" : {"name" : processName if processName is not None else "pycubemx " + str(self.pid)},
+        }]
+
+    @staticmethod
+    def now ():
+        return time.time() * 1000000.0
+
+    def _add (self, event, traceId):
+        event["pid"] = self.pid
+        event["tid"] = threading.get_ident()
+        if traceId is not None:
+            event.setdefault("args", {})["trace"] = traceId
+        with self._lock:
+            self.events.append(event)
+
+    def complete (self, name, start, traceId = None, cat = "pycubemx", **args):
+        """ Records a span that began at start (from now()) and ends now. """
+        self._add({"name" : name, "cat" : cat, "ph" : "X", "ts" : start,
+                   "dur" : self.now() - start, "args" : args}, traceId)
+
+    def instant (self, name, traceId = None, cat = "pycubemx", **args):
+        self._add({"name" : name, "cat" : cat, "ph" : "i", "s" : "t",
+                   "ts" : self.now(), "args" : args}, traceId)
+
+    @contextmanager
+    def span (self, name, traceId = None, cat = "pycubemx", **args):
+        """ Records the with block as a span; the yielded dict becomes its args. """
+        start = self.now()
+        try:
+            yield args
+        finally:
+            self.complete(name, start, traceId, cat, **args)
+
+    def extend (self, events):
+        """ Adds events recorded elsewhere, e.g. returned by the server. """
+        with self._lock:
+            self.events.extend(events)
+
+    def forTrace (self, traceId):
+        with self._lock:
+            return [i for i in self.events if i["ph"] == "M" or i.get("args", {}).get("trace") == traceId]
+
+    def clear (self):
+        with self._lock:
+            self.events = [i for i in self.events if i["ph"] == "M"]
+
+    def save (self, path):
+        with self._lock:
+            data = {"traceEvents" : list(self.events), "displayTimeUnit" : "ms"}
+        with open(str(path), "w") as f:
+            json.dump(data, f)
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import logging
+import threading
+import collections
+from subprocess import TimeoutExpired
+from .native import MxConnection, Encoding
+
+Log = logging.getLogger(__name__)
+
+__ALL__ = ("MxReplayConnection", "Transcript", "TranscriptWriter")
+
+class TranscriptWriter (object):
+    """
+    Appends the exchange of a session to a transcript file, one JSON object
+    per line: a "start" record for each CubeMX start with its start-up time,
+    then a "command" record per command with the lines received and the
+    seconds from the response being awaited to each line. After close() the
+    file is opened again by the next record, e.g. when the session restarts.
+    """
+    def __init__ (self, path):
+        self.path = str(path)
+        self._file = open(self.path, "a")
+        self._lock = threading.Lock()
+
+    def _write (self, record):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def start (self, command, startupTime):
+        self._write({"type" : "start", "command" : command, "startup" : startupTime})
+
+    def command (self, command, lines):
+        self._write({"type" : "command", "command" : command, "lines" : lines})
+
+    def close (self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class Transcript (object):
+    """
+    A recorded transcript. Responses are served per command line in the
+    order they were recorded; the last one repeats once they run out.
+    """
+    def __init__ (self, path):
+        self.path = str(path)
+        self.startup = 0.0
+        self._responses = collections.OrderedDict()
+        with open(self.path, "r") as f:
+            for line in f:
+                if len(line.strip()) == 0:
+                    continue
+                record = json.loads(line)
+                if record["type"] == "start" and len(self._responses) == 0:
+                    self.startup = record["startup"]
+                elif record["type"] == "command":
+                    self._responses.setdefault(record["command"], []).append(record["lines"])
+        self._served = {}
+
+    @property
+    def commands (self):
+        return list(self._responses.keys())
+
+    def response (self, command):
+        """ The recorded [seconds, line] pairs for command, or None. """
+        responses = self._responses.get(command)
+        if responses is None:
+            return None
+        n = self._served.get(command, 0)
+        self._served[command] = n + 1
+        return responses[min(n, len(responses) - 1)]
+
+class _ReplayProcess (object):
+    """ Stands in for the CubeMX process, answering commands from a transcript. """
+    def __init__ (self, transcript, realtime):
+        self._transcript = transcript
+        self._realtime = realtime
+        inRead, inWrite = os.pipe()
+        outRead, self._outWrite = os.pipe()
+        errRead, errWrite = os.pipe()
+        os.close(errWrite)
+        self._in = os.fdopen(inRead, "rb")
+        self.stdin = os.fdopen(inWrite, "wb")
+        self.stdout = os.fdopen(outRead, "rb")
+        self.stderr = os.fdopen(errRead, "rb")
+        self.returncode = None
+        self._killed = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _send (self, data):
+        os.write(self._outWrite, bytes(data, Encoding))
+
+    def _pause (self, seconds):
+        if self._realtime and seconds > 0:
+            self._killed.wait(seconds)
+
+    def _serve (self):
+        try:
+            self._pause(self._transcript.startup)
+            self._send("MX>\n")
+            for line in self._in:
+                if self._killed.is_set():
+                    break
+                command = line.decode(Encoding).strip()
+                if len(command) == 0:
+                    continue
+                if command == "exit":
+                    break
+                response = self._transcript.response(command)
+                if response is None:
+                    Log.warning("Not in transcript: " + command)
+                    self._send("Command not in transcript: {}\n0 KO\n".format(command))
+                    continue
+                started = time.monotonic()
+                for offset, text in response:
+                    self._pause(offset - (time.monotonic() - started))
+                    if self._killed.is_set():
+                        return
+                    self._send(text + "\n")
+        except OSError:
+            pass
+        finally:
+            self.returncode = 0
+            try:
+                os.close(self._outWrite)
+            except OSError:
+                pass
+
+    def poll (self):
+        return self.returncode
+
+    def wait (self, timeout = None):
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            raise TimeoutExpired("replay", timeout)
+        return self.returncode
+
+    def kill (self):
+        self._killed.set()
+        try:
+            self.stdin.close()
+        except OSError:
+            pass
+
+class MxReplayConnection (MxConnection):
+    """
+    An MxConnection answered from a transcript recorded with
+    MxConnection(config, record="session.jsonl") instead of a CubeMX
+    process. Responses come back instantly, or with their recorded timing
+    when realtime is set. Commands missing from the transcript fail with KO.
+    """
+    def __init__ (self, config, transcript, realtime = False, **kwargs):
+        super().__init__(config, **kwargs)
+        self._transcript = transcript if isinstance(transcript, Transcript) else Transcript(transcript)
+        self._realtime = realtime
+
+    def _spawn (self, cmd):
+        return _ReplayProcess(self._transcript, self._realtime)